@@ -1,6 +1,15 @@
 # evekit.marketdata package
 from .market_history import MarketHistory
+from .columnar_book import ColumnarOrderBook, SnapshotColumns, SnapshotDiff, ORDER_DTYPE
+from .price_ladder import PriceLadder
+from .bulk_index import BulkIndex, RegionIndex
+from .archive_client import ArchiveClient
+from .archive_cache import ArchiveCache
+from .service_pool import ServicePool, TokenBucket
+from .book_cache import BookCache
+from .book_store import BookStore
+from .history_store import HistoryStore
 from .order_book import OrderBook, MarketOrder, MarketSnapshot
 from .trading import TradingUtil
-
-
+from .trade_inference import TradeInference
+from .liquidity_screen import LiquidityScreen
@@ -0,0 +1,209 @@
+# evekit.marketdata.ArchiveCache module
+"""
+Read-through disk cache for data downloaded from the online archive.  Archive files never change once
+published, so cached byte ranges are used without revalidation.  Entries are evicted least recently used
+first when the cache grows beyond a configured number of bytes.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+class ArchiveCache:
+    """
+    Disk cache of byte ranges of archive files.  Each entry is a file below the cache directory named after
+    the archive host, the file path and the byte range, e.g. host/2017/01/01/interval_20170101_5.bulk.0-1023.
+    Entry use is tracked by file modification time so that recency survives restarts.  The size bound is
+    applied to the entries this process knows about, which are the entries present when the cache is first
+    used plus those added since, so several processes sharing a directory may briefly exceed the bound.
+    """
+    default_size = 4 * 1024 * 1024 * 1024
+    """
+    Default maximum cache size in bytes.
+    """
+    __caches__ = {}
+    __caches_lock__ = threading.Lock()
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        :param directory: cache directory, created if it does not exist
+        :param max_bytes: maximum total size of cached entries in bytes, or None for ArchiveCache.default_size
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = self.default_size if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.evictions = 0
+        self.__entries__ = None
+        self.__total__ = 0
+        self.__lock__ = threading.Lock()
+
+    @staticmethod
+    def get_cache(directory, max_bytes=None):
+        """
+        :param directory: cache directory
+        :param max_bytes: maximum total size of cached entries in bytes, or None for ArchiveCache.default_size
+        :return: shared ArchiveCache for the directory.  The cache is resized if max_bytes is given.
+        """
+        key = os.path.abspath(directory)
+        with ArchiveCache.__caches_lock__:
+            if key not in ArchiveCache.__caches__:
+                ArchiveCache.__caches__[key] = ArchiveCache(directory, max_bytes)
+            result = ArchiveCache.__caches__[key]
+        if max_bytes is not None and max_bytes != result.max_bytes:
+            result.resize(max_bytes)
+        return result
+
+    @staticmethod
+    def from_config(config):
+        """
+        Get the cache to use for a reader config.
+
+        :param config: config with optional settings archive_cache and archive_cache_size as described in
+                       OrderBook.get_day
+        :return: shared ArchiveCache for config['archive_cache'], or None if no cache is configured
+        """
+        if config.get('archive_cache', None) is None:
+            return None
+        return ArchiveCache.get_cache(config['archive_cache'], config.get('archive_cache_size', None))
+
+    def __load_entries__(self):
+        # Scan the cache directory once, ordering existing entries from least to most recently used
+        if self.__entries__ is not None:
+            return
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime_ns, os.path.join(root, name), stat.st_size))
+        found.sort()
+        self.__entries__ = OrderedDict([(path, size) for _, path, size in found])
+        self.__total__ = sum([size for _, _, size in found])
+
+    def entry_path(self, key, start, end):
+        """
+        :param key: archive file key, i.e. host and path of the archive file
+        :param start: first byte of the range
+        :param end: last byte of the range, or -1 for end of file
+        :return: path of the cache entry for the range
+        """
+        return os.path.join(self.directory, key.replace(":", "_").lstrip("/")) + ".%d-%d" % (start, end)
+
+    def get(self, key, start, end):
+        """
+        Look up a cached range.
+
+        :param key: archive file key, i.e. host and path of the archive file
+        :param start: first byte of the range
+        :param end: last byte of the range, or -1 for end of file
+        :return: cached bytes, or None if the range is not cached
+        """
+        path = self.entry_path(key, start, end)
+        try:
+            with open(path, 'rb') as fobj:
+                data = fobj.read()
+            os.utime(path)
+        except OSError:
+            data = None
+        with self.__lock__:
+            self.__load_entries__()
+            if data is None:
+                self.misses += 1
+                self.__total__ -= self.__entries__.pop(path, 0)
+                return None
+            self.hits += 1
+            self.hit_bytes += len(data)
+            if path not in self.__entries__:
+                # Added by another process
+                self.__entries__[path] = len(data)
+                self.__total__ += len(data)
+            self.__entries__.move_to_end(path)
+        return data
+
+    def put(self, key, start, end, data):
+        """
+        Add a range to the cache, evicting least recently used entries if the cache is over its size bound.
+        Failures to write are ignored since the cache is an optimization only.
+
+        :param key: archive file key, i.e. host and path of the archive file
+        :param start: first byte of the range
+        :param end: last byte of the range, or -1 for end of file
+        :param data: bytes of the range
+        """
+        if len(data) > self.max_bytes:
+            return
+        path = self.entry_path(key, start, end)
+        tmp_path = path + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as fobj:
+                fobj.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self.__lock__:
+            self.__load_entries__()
+            self.__total__ += len(data) - self.__entries__.pop(path, 0)
+            self.__entries__[path] = len(data)
+            self.__evict__()
+
+    def resize(self, max_bytes):
+        """
+        Change the size bound, evicting entries if the cache is now over the bound.
+
+        :param max_bytes: maximum total size of cached entries in bytes
+        """
+        with self.__lock__:
+            self.__load_entries__()
+            self.max_bytes = max_bytes
+            self.__evict__()
+
+    def __evict__(self):
+        # Remove least recently used entries until the cache fits.  Caller must hold the lock.
+        while self.__total__ > self.max_bytes and len(self.__entries__) > 0:
+            old_path, old_size = self.__entries__.popitem(last=False)
+            self.__total__ -= old_size
+            self.evictions += 1
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Remove all cached entries known to this process.
+        """
+        with self.__lock__:
+            self.__load_entries__()
+            for path in self.__entries__.keys():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.__entries__.clear()
+            self.__total__ = 0
+
+    def stats(self):
+        """
+        :return: dict with hits, misses, hit_bytes (bytes served from the cache), evictions, entries and bytes
+                 (current size of the cache)
+        """
+        with self.__lock__:
+            self.__load_entries__()
+            return {'hits': self.hits, 'misses': self.misses, 'hit_bytes': self.hit_bytes,
+                    'evictions': self.evictions, 'entries': len(self.__entries__), 'bytes': self.__total__}
+
+    def __str__(self):
+        stats = self.stats()
+        return "ArchiveCache[%s, entries=%d, bytes=%d, hits=%d, misses=%d]" % (self.directory, stats['entries'],
+                                                                               stats['bytes'], stats['hits'],
+                                                                               stats['misses'])
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,294 @@
+# evekit.marketdata.ArchiveClient module
+"""
+HTTP access to the online market data archive.  Byte ranges of a bulk file are coalesced into a small
+number of large range requests, which are sent over pooled keep-alive connections and split locally.
+Range requests may be sent concurrently from a thread pool to hide network latency.
+"""
+import os
+import threading
+import concurrent.futures
+from collections import deque
+import http.client
+import urllib.error
+import urllib.parse
+
+ARCHIVE_URL = "https://storage.googleapis.com/evekit_md/"
+"""
+Default base URL of the online archive.  Files for a date are stored under YYYY/MM/DD below this URL.
+"""
+
+
+def coalesce_ranges(ranges, max_gap=256 * 1024, max_request_size=64 * 1024 * 1024):
+    """
+    Group inclusive byte ranges into larger ranges which can be fetched with one request each.  Ranges are
+    merged when the gap between them is at most max_gap and the merged range is at most max_request_size.
+    An end offset of -1 means the range extends to the end of the file.
+
+    :param ranges: array-like of (start, end) inclusive ranges
+    :param max_gap: largest number of unwanted bytes to fetch between two merged ranges
+    :param max_request_size: largest merged range in bytes.  A single range larger than this is not split.
+    :return: list of (start, end, members) where members is the list of positions in ranges covered by
+             the merged range, in file order
+    """
+    groups = []
+    for pos in sorted(range(len(ranges)), key=lambda x: ranges[x][0]):
+        start, end = ranges[pos]
+        if len(groups) > 0:
+            group_start, group_end, members = groups[-1]
+            if group_end == -1 or start <= group_end + 1 + max_gap:
+                new_end = -1 if end == -1 or group_end == -1 else max(end, group_end)
+                # The size of an open ended range is not known, so only its start is checked
+                if (start if new_end == -1 else new_end) - group_start + 1 <= max_request_size:
+                    groups[-1] = (group_start, new_end, members + [pos])
+                    continue
+        groups.append((start, end, [pos]))
+    return groups
+
+
+class ArchiveClient:
+    """
+    Client for one archive host which keeps idle keep-alive connections for reuse.  Clients are safe to share
+    between threads; each request uses its own connection.  Use ArchiveClient.get_client to share one client
+    per base URL.  Idle connections are never reused across a fork, so forked workers (e.g. a process day
+    pool) open their own connections.
+    """
+    max_gap = 256 * 1024
+    """
+    Default largest number of unwanted bytes fetched between two coalesced ranges.
+    """
+    max_request_size = 64 * 1024 * 1024
+    """
+    Default largest coalesced range request in bytes.
+    """
+    min_split_size = 1024 * 1024
+    """
+    When fetching concurrently, coalesced ranges are limited in size so that there is a request for each
+    worker, but are not made smaller than this.
+    """
+    __clients__ = {}
+    __clients_lock__ = threading.Lock()
+
+    def __init__(self, base_url=ARCHIVE_URL, timeout=60):
+        """
+        :param base_url: base URL of the archive, e.g. ARCHIVE_URL or http://localhost:8000/
+        :param timeout: socket timeout in seconds for each request
+        """
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        parsed = urllib.parse.urlsplit(self.base_url)
+        if parsed.scheme not in ('http', 'https'):
+            raise Exception("Unsupported archive URL: %s" % base_url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path
+        self.timeout = timeout
+        self.request_count = 0
+        self.__pid__ = os.getpid()
+        self.__idle__ = []
+        self.__lock__ = threading.Lock()
+
+    @staticmethod
+    def get_client(base_url=None):
+        """
+        :param base_url: base URL of the archive, or None for ARCHIVE_URL
+        :return: shared ArchiveClient for the base URL
+        """
+        base_url = ARCHIVE_URL if base_url is None else base_url
+        with ArchiveClient.__clients_lock__:
+            if base_url not in ArchiveClient.__clients__:
+                ArchiveClient.__clients__[base_url] = ArchiveClient(base_url)
+            return ArchiveClient.__clients__[base_url]
+
+    def url(self, path):
+        """
+        :param path: path of a file relative to the archive base
+        :return: full URL of the file
+        """
+        return self.base_url + path
+
+    def __connect__(self):
+        if self.__pid__ != os.getpid():
+            # Inherited from the parent process, whose idle connections share sockets with this one.  Drop
+            # them without closing so the parent can keep using them.
+            self.__pid__ = os.getpid()
+            self.__idle__ = []
+            self.__lock__ = threading.Lock()
+        with self.__lock__:
+            if len(self.__idle__) > 0:
+                return self.__idle__.pop(), True
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout), False
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout), False
+
+    def __request__(self, path, headers):
+        # Send one request and return (status, body).  A pooled connection may have been closed by the
+        # server while idle, in which case the request is retried once on a new connection.
+        while True:
+            connection, reused = self.__connect__()
+            try:
+                connection.request('GET', self.base_path + path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            with self.__lock__:
+                self.request_count += 1
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.__idle__.append(connection)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(self.url(path), response.status, response.reason, response.headers, None)
+            return response.status, body
+
+    def cache_key(self, path):
+        """
+        :param path: path of a file relative to the archive base
+        :return: key identifying the file in an ArchiveCache
+        """
+        return self.netloc + self.base_path + path
+
+    def fetch(self, path, cache=None):
+        """
+        Retrieve a complete file.
+
+        :param path: path of the file relative to the archive base
+        :param cache: optional ArchiveCache to read through
+        :return: file contents as bytes
+        """
+        if cache is not None:
+            data = cache.get(self.cache_key(path), 0, -1)
+            if data is not None:
+                return data
+        data = self.__request__(path, {})[1]
+        if cache is not None:
+            cache.put(self.cache_key(path), 0, -1, data)
+        return data
+
+    def fetch_range(self, path, start, end):
+        """
+        Retrieve an inclusive byte range of a file.
+
+        :param path: path of the file relative to the archive base
+        :param start: first byte to retrieve
+        :param end: last byte to retrieve, or -1 to retrieve to the end of the file
+        :return: requested bytes
+        """
+        range_string = "bytes=" + str(start) + "-"
+        if end != -1:
+            range_string += str(end)
+        status, body = self.__request__(path, {"Range": range_string})
+        if status != 206:
+            # Server ignored the range and sent the whole file
+            body = body[start:] if end == -1 else body[start:end + 1]
+        return body
+
+    def iter_ranges(self, path, ranges, max_gap=None, max_request_size=None, max_concurrency=1, decode=None,
+                    cache=None):
+        """
+        Retrieve byte ranges of a file with as few requests as possible.  Ranges are coalesced as described
+        in coalesce_ranges.  If max_concurrency is greater than one, up to that many requests are in flight
+        at once, each on its own connection, while the caller consumes earlier results.  If a cache is given,
+        each range is looked up in the cache first and fetched ranges are added to it.
+
+        :param path: path of the file relative to the archive base
+        :param ranges: array-like of (start, end) inclusive ranges, where an end of -1 means end of file
+        :param max_gap: override for ArchiveClient.max_gap
+        :param max_request_size: override for ArchiveClient.max_request_size
+        :param max_concurrency: maximum number of concurrent requests
+        :param decode: optional function applied to the bytes of each range in the fetching thread, e.g.
+                       gzip.decompress, so that decoding overlaps other requests
+        :param cache: optional ArchiveCache to read through
+        :return: generator yielding (position in ranges, range bytes or decoded value).  Cached ranges are
+                 yielded first, then fetched ranges in file order.
+        """
+        if cache is None:
+            yield from self.__iter_fetched__(path, ranges, max_gap, max_request_size, max_concurrency, decode, None)
+            return
+        key = self.cache_key(path)
+        missing = []
+        for pos in range(len(ranges)):
+            data = cache.get(key, ranges[pos][0], ranges[pos][1])
+            if data is None:
+                missing.append(pos)
+            else:
+                yield pos, data if decode is None else decode(data)
+        for pos, value in self.__iter_fetched__(path, [ranges[x] for x in missing], max_gap, max_request_size,
+                                                max_concurrency, decode, cache):
+            yield missing[pos], value
+
+    def __iter_fetched__(self, path, ranges, max_gap, max_request_size, max_concurrency, decode, cache):
+        # Fetch ranges as described in iter_ranges, adding each range to the cache if present
+        max_gap = self.max_gap if max_gap is None else max_gap
+        max_request_size = self.max_request_size if max_request_size is None else max_request_size
+        if max_concurrency > 1 and len(ranges) > 1:
+            # Limit request size so there is work for every worker
+            known = [x for x in ranges if x[1] != -1]
+            if len(known) > 0:
+                span = max([x[1] for x in known]) - min([x[0] for x in ranges]) + 1
+                max_request_size = min(max_request_size, max(self.min_split_size, span // max_concurrency + 1))
+        groups = coalesce_ranges(ranges, max_gap, max_request_size)
+        if max_concurrency <= 1 or len(groups) <= 1:
+            for next_group in groups:
+                yield from self.__fetch_group__(path, ranges, next_group, decode, cache)
+            return
+        pending = deque(groups)
+        inflight = deque()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            while len(pending) > 0 or len(inflight) > 0:
+                while len(pending) > 0 and len(inflight) < max_concurrency:
+                    inflight.append(executor.submit(self.__fetch_group__, path, ranges, pending.popleft(),
+                                                    decode, cache))
+                result = inflight.popleft().result()
+                # Start the next request before handing results to the caller
+                if len(pending) > 0:
+                    inflight.append(executor.submit(self.__fetch_group__, path, ranges, pending.popleft(),
+                                                    decode, cache))
+                yield from result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def __fetch_group__(self, path, ranges, group, decode, cache):
+        # Fetch one coalesced range and split it into its members
+        start, end, members = group
+        data = memoryview(self.fetch_range(path, start, end))
+        result = []
+        for pos in members:
+            member_start, member_end = ranges[pos]
+            offset = member_start - start
+            value = data[offset:] if member_end == -1 else data[offset:member_end - start + 1]
+            if cache is not None:
+                cache.put(self.cache_key(path), member_start, member_end, value)
+            result.append((pos, value if decode is None else decode(value)))
+        return result
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.__lock__:
+            for next_connection in self.__idle__:
+                next_connection.close()
+            self.__idle__ = []
+
+    @staticmethod
+    def __after_fork__():
+        # Shared clients in a forked child start from scratch
+        ArchiveClient.__clients__ = {}
+        ArchiveClient.__clients_lock__ = threading.Lock()
+
+    def __str__(self):
+        return "ArchiveClient[%s, requests=%d]" % (self.base_url, self.request_count)
+
+    def __repr__(self):
+        return str(self)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=ArchiveClient.__after_fork__)
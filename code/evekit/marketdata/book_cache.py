@@ -0,0 +1,189 @@
+# evekit.marketdata.BookCache module
+"""
+In-process cache of parsed order books, so that repeated loads of the same day do not re-read and re-parse
+the underlying data.  Books are cached in columnar form with read-only arrays, and evicted least recently
+used first when the cache grows beyond a configured number of bytes.
+"""
+import threading
+from collections import OrderedDict
+from .columnar_book import SnapshotColumns
+
+__entry_overhead__ = 256
+"""
+Approximate bytes charged for each cache entry in addition to its arrays.
+"""
+
+
+class BookCache:
+    """
+    Cache of SnapshotColumns keyed by (source, date, type_id, region_id), where source identifies the data the
+    books were read from (e.g. a local bulk file and its modification time, or an archive URL), so that books
+    from another source or from a replaced file are not returned.  When a type is loaded for all regions, the
+    list of regions found is also cached so that later loads for all regions can be served from the cache.
+    Regions which were requested but not present are cached as absent.  Cached arrays are marked read-only
+    and each lookup returns new SnapshotColumns objects over them, so callers can not change the cache.
+    Safe to share between threads.
+    """
+    default_size = 1024 * 1024 * 1024
+    """
+    Default maximum cache size in bytes.
+    """
+    __default__ = None
+    __default_lock__ = threading.Lock()
+
+    def __init__(self, max_bytes=None):
+        """
+        :param max_bytes: maximum approximate size of cached books in bytes, or None for BookCache.default_size
+        """
+        self.max_bytes = self.default_size if max_bytes is None else max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries__ = OrderedDict()
+        self.__total__ = 0
+        self.__lock__ = threading.Lock()
+
+    @staticmethod
+    def get_default(max_bytes=None):
+        """
+        :param max_bytes: if present, the new size bound of the shared cache
+        :return: the shared BookCache for this process
+        """
+        with BookCache.__default_lock__:
+            if BookCache.__default__ is None:
+                BookCache.__default__ = BookCache(max_bytes)
+            result = BookCache.__default__
+        if max_bytes is not None and max_bytes != result.max_bytes:
+            result.resize(max_bytes)
+        return result
+
+    @staticmethod
+    def from_config(config):
+        """
+        Get the cache to use for a reader config.
+
+        :param config: config with optional settings book_cache and book_cache_size as described in
+                       OrderBook.get_day
+        :return: the BookCache to use, or None if no cache is configured
+        """
+        value = config.get('book_cache', None)
+        if value is None or value is False:
+            return None
+        if isinstance(value, BookCache):
+            return value
+        return BookCache.get_default(config.get('book_cache_size', None))
+
+    @staticmethod
+    def __day_key__(date, source):
+        return source, date.year, date.month, date.day
+
+    @staticmethod
+    def __view__(columns):
+        return SnapshotColumns(columns.snapshot_time, columns.bid_count, columns.offsets, columns.orders)
+
+    def get(self, date, type_id, regions, source=None):
+        """
+        Look up a cached book.
+
+        :param date: date of the book
+        :param type_id: type of the book
+        :param regions: array-like of wanted regions, or None for all regions
+        :param source: hashable key identifying the data the book is read from
+        :return: map from region ID to read-only SnapshotColumns for the wanted regions present in the book,
+                 or None if any wanted region is not cached
+        """
+        day = BookCache.__day_key__(date, source)
+        with self.__lock__:
+            if regions is None:
+                key = (day, type_id, None)
+                if key not in self.__entries__:
+                    self.misses += 1
+                    return None
+                regions = self.__entries__[key][0]
+                self.__entries__.move_to_end(key)
+            keys = [(day, type_id, x) for x in regions]
+            if any([x not in self.__entries__ for x in keys]):
+                self.misses += 1
+                return None
+            self.hits += 1
+            result = {}
+            for next_key in keys:
+                self.__entries__.move_to_end(next_key)
+                columns = self.__entries__[next_key][0]
+                if columns is not None:
+                    result[next_key[2]] = BookCache.__view__(columns)
+            return result
+
+    def put(self, date, type_id, regions, region_map, source=None):
+        """
+        Add a book to the cache.  The arrays of the book are marked read-only.
+
+        :param date: date of the book
+        :param type_id: type of the book
+        :param regions: array-like of regions the book was loaded for, or None if it was loaded for all regions
+        :param region_map: map from region ID to SnapshotColumns as loaded
+        :param source: hashable key identifying the data the book was read from
+        :return: map from region ID to read-only SnapshotColumns, as get would return
+        """
+        day = BookCache.__day_key__(date, source)
+        entries = []
+        if regions is None:
+            regions = list(region_map.keys())
+            entries.append(((day, type_id, None), tuple(regions), __entry_overhead__))
+        for next_region in regions:
+            columns = region_map.get(next_region, None)
+            size = __entry_overhead__
+            if columns is not None:
+                for next_array in (columns.snapshot_time, columns.bid_count, columns.offsets, columns.orders):
+                    next_array.flags.writeable = False
+                size += columns.nbytes
+            entries.append(((day, type_id, next_region), columns, size))
+        with self.__lock__:
+            for key, value, size in entries:
+                if key in self.__entries__:
+                    self.__total__ -= self.__entries__.pop(key)[1]
+                self.__entries__[key] = (value, size)
+                self.__total__ += size
+            self.__evict__()
+        return {k: BookCache.__view__(region_map[k]) for k in regions if region_map.get(k, None) is not None}
+
+    def resize(self, max_bytes):
+        """
+        Change the size bound, evicting books if the cache is now over the bound.
+
+        :param max_bytes: maximum approximate size of cached books in bytes
+        """
+        with self.__lock__:
+            self.max_bytes = max_bytes
+            self.__evict__()
+
+    def __evict__(self):
+        # Remove least recently used entries until the cache fits.  Caller must hold the lock.
+        while self.__total__ > self.max_bytes and len(self.__entries__) > 0:
+            self.__total__ -= self.__entries__.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all cached books.
+        """
+        with self.__lock__:
+            self.__entries__.clear()
+            self.__total__ = 0
+
+    def stats(self):
+        """
+        :return: dict with hits and misses (counted per type lookup), evictions, entries and bytes (current
+                 approximate size of the cache)
+        """
+        with self.__lock__:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.__entries__), 'bytes': self.__total__}
+
+    def __str__(self):
+        stats = self.stats()
+        return "BookCache[entries=%d, bytes=%d, hits=%d, misses=%d]" % (stats['entries'], stats['bytes'],
+                                                                       stats['hits'], stats['misses'])
+
+    def __repr__(self):
+        return str(self)
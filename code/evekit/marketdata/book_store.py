@@ -0,0 +1,149 @@
+# evekit.marketdata.BookStore module
+"""
+Compiled on-disk store for a day of columnar order books.  A store is written once from an interval
+bulk file and can then be loaded with memory mapping and no decompression or parsing.
+
+File layout (all integers little-endian):
+
+  magic (8 bytes)
+  for each (type, region): snapshot_time, bid_count, offsets and orders arrays, each 8 byte aligned
+  type table - one (type_id, first_region, region_count) record per type, in bulk file order
+  region table - one record per (type, region) giving region_id, snapshot_count, order_count and the
+                 file offset of each array
+  trailer - type table offset, type count, region table offset, region count, magic
+"""
+import os
+import mmap
+import struct
+import numpy as np
+from .columnar_book import ColumnarOrderBook, SnapshotColumns, ORDER_DTYPE
+
+__store_magic__ = b'EKBOOK01'
+
+__trailer__ = struct.Struct('<qqqq8s')
+
+__type_dtype__ = np.dtype([('type_id', '<i8'), ('first_region', '<i8'), ('region_count', '<i8')])
+
+__region_dtype__ = np.dtype([('region_id', '<i8'), ('snapshot_count', '<i8'), ('order_count', '<i8'),
+                             ('snapshot_time', '<i8'), ('bid_count', '<i8'), ('offsets', '<i8'), ('orders', '<i8')])
+
+__column_types__ = (('snapshot_time', np.dtype('<i8')), ('bid_count', np.dtype('<i4')), ('offsets', np.dtype('<i8')),
+                    ('orders', ORDER_DTYPE))
+
+
+class BookStore:
+    """
+    Read-only view of a compiled book store.  Arrays of loaded books are views of the memory mapped
+    file, so loading is essentially free until the data is touched.
+    """
+    def __init__(self, path):
+        """
+        Open a compiled book store.
+
+        :param path: path to the store file
+        """
+        self.path = path
+        with open(path, 'rb') as fd:
+            self.__map__ = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.__map__) < len(__store_magic__) + __trailer__.size or \
+                self.__map__[:len(__store_magic__)] != __store_magic__:
+            raise Exception("Not a compiled book store: %s" % path)
+        type_offset, type_count, region_offset, region_count, magic = \
+            __trailer__.unpack_from(self.__map__, len(self.__map__) - __trailer__.size)
+        if magic != __store_magic__:
+            raise Exception("Truncated compiled book store: %s" % path)
+        self.type_table = np.frombuffer(self.__map__, dtype=__type_dtype__, count=type_count, offset=type_offset)
+        self.region_table = np.frombuffer(self.__map__, dtype=__region_dtype__, count=region_count,
+                                          offset=region_offset)
+        self.__type_position__ = {int(x): i for i, x in enumerate(self.type_table['type_id'])}
+
+    @property
+    def types(self):
+        """
+        :return: list of type IDs in the store, in bulk file order
+        """
+        return [int(x) for x in self.type_table['type_id']]
+
+    def __contains__(self, type_id):
+        return type_id in self.__type_position__
+
+    def read(self, dt, type_id, region_id=None, size=5):
+        """
+        Load a single type from the store.
+
+        :param dt: datetime for day represented by order book
+        :param type_id: type to load
+        :param region_id: optional set of region IDs to include.  If None, then include all regions.
+        :param size: interval size in minutes
+        :return: a ColumnarOrderBook, or None if the type is not in the store
+        """
+        if type_id not in self.__type_position__:
+            return None
+        region_set = None if region_id is None else set(region_id)
+        entry = self.type_table[self.__type_position__[type_id]]
+        book = ColumnarOrderBook(dt, size)
+        book.type_id = type_id
+        first = int(entry['first_region'])
+        for next_region in self.region_table[first:first + int(entry['region_count'])]:
+            if region_set is not None and int(next_region['region_id']) not in region_set:
+                continue
+            counts = {'snapshot_time': int(next_region['snapshot_count']),
+                      'bid_count': int(next_region['snapshot_count']),
+                      'offsets': int(next_region['snapshot_count']) + 1,
+                      'orders': int(next_region['order_count'])}
+            arrays = [np.frombuffer(self.__map__, dtype=dtype, count=counts[name], offset=int(next_region[name]))
+                      for name, dtype in __column_types__]
+            book.region[int(next_region['region_id'])] = SnapshotColumns(*arrays)
+        return book
+
+    @staticmethod
+    def write(path, books):
+        """
+        Write a compiled book store.  Books are consumed one at a time so a full day never needs to be
+        held in memory.  The store is written to a temporary file and renamed into place when complete.
+
+        :param path: path of the store file to create
+        :param books: iterable of ColumnarOrderBook, in the order types should appear in the store
+        :return: number of types written
+        """
+        type_rows = []
+        region_rows = []
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as fobj:
+                fobj.write(__store_magic__)
+                for next_book in books:
+                    type_rows.append((next_book.type_id, len(region_rows), len(next_book.region)))
+                    for region_id in next_book.region.keys():
+                        columns = next_book.region[region_id]
+                        row = [region_id, len(columns), len(columns.orders)]
+                        for name, dtype in __column_types__:
+                            BookStore.__align__(fobj)
+                            row.append(fobj.tell())
+                            fobj.write(np.ascontiguousarray(getattr(columns, name), dtype=dtype).tobytes())
+                        region_rows.append(tuple(row))
+                BookStore.__align__(fobj)
+                type_offset = fobj.tell()
+                fobj.write(np.array(type_rows, dtype=__type_dtype__).tobytes())
+                region_offset = fobj.tell()
+                fobj.write(np.array(region_rows, dtype=__region_dtype__).tobytes())
+                fobj.write(__trailer__.pack(type_offset, len(type_rows), region_offset, len(region_rows),
+                                            __store_magic__))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return len(type_rows)
+
+    @staticmethod
+    def __align__(fobj):
+        pad = -fobj.tell() % 8
+        if pad > 0:
+            fobj.write(b'\x00' * pad)
+
+    def __str__(self):
+        return "BookStore[%s, %d types, %d regions]" % (self.path, len(self.type_table), len(self.region_table))
+
+    def __repr__(self):
+        return str(self)
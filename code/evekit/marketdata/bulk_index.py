@@ -0,0 +1,303 @@
+# evekit.marketdata.BulkIndex module
+"""
+Parsed form of the .index.gz files which accompany order book and market history bulk files.  Each
+line of an index file gives the name of a per-type block (which includes the type ID) and the offset
+of that block in the bulk file.  The parsed index is kept as NumPy arrays so that type lookup is a
+binary search, and local indexes are cached in-process (and optionally in a sidecar file) so that
+repeated loads of the same day do not re-read the index.
+"""
+import os
+import gzip
+import threading
+from collections import OrderedDict
+import numpy as np
+
+__sidecar_dtype__ = np.dtype([('type_id', '<i8'), ('start', '<i8')])
+
+
+class BulkIndex:
+    """
+    Map from type ID to the (start, end) offsets of the type block in a bulk file.  Offsets are inclusive.
+    The end offset of the last block is the max_offset given when the index was read.  The keys() and
+    items() methods iterate in bulk file order.
+    """
+    cache_size = 256
+    """
+    Maximum number of parsed local indexes kept in memory.
+    """
+    __cache__ = OrderedDict()
+    __cache_lock__ = threading.Lock()
+
+    def __init__(self, type_id, start, max_offset):
+        """
+        Create an index from block starts in bulk file order.  If a type appears more than once, the
+        last occurrence wins.
+
+        :param type_id: array-like of type IDs in bulk file order
+        :param start: array-like of block start offsets in bulk file order
+        :param max_offset: end offset to report for the last block
+        """
+        self.type_id = np.asarray(type_id, dtype=np.int64)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.empty(len(self.start), dtype=np.int64)
+        self.end[:-1] = self.start[1:] - 1
+        self.end[-1:] = max_offset
+        self.max_offset = max_offset
+        # Sorted view for lookup, keeping only the last occurrence of any duplicate type
+        order = np.argsort(self.type_id, kind='stable')
+        keep = np.ones(len(order), dtype=bool)
+        keep[:-1] = self.type_id[order][1:] != self.type_id[order][:-1]
+        self.__sorted_pos__ = order[keep]
+        self.__sorted_type__ = self.type_id[self.__sorted_pos__]
+
+    @staticmethod
+    def parse(fobj, max_offset):
+        """
+        Read an index file.
+
+        :param fobj: file object to read from
+        :param max_offset: max offset to report for last value
+        :return: new BulkIndex
+        """
+        type_id = []
+        start = []
+        for line in gzip.GzipFile(fileobj=fobj).read().split(b'\n'):
+            if len(line) == 0:
+                continue
+            fields = line.split(b' ')
+            type_id.append(int(fields[0].split(b'_')[1]))
+            start.append(int(fields[1]))
+        return BulkIndex(type_id, start, max_offset)
+
+    @staticmethod
+    def load(index_file, max_offset, sidecar=False):
+        """
+        Read a local index file through the in-process cache.  Cache entries are keyed by path, size and
+        modification time of the index file, so a replaced index is always re-read.
+
+        :param index_file: path of the .index.gz file
+        :param max_offset: max offset to report for last value, normally the size of the bulk file
+        :param sidecar: if True, read (or create) a binary copy of the index next to the index file
+                        to avoid decompressing the index in new processes
+        :return: BulkIndex for the file
+        """
+        stat = os.stat(index_file)
+        key = (os.path.abspath(index_file), stat.st_mtime_ns, stat.st_size, max_offset)
+        with BulkIndex.__cache_lock__:
+            if key in BulkIndex.__cache__:
+                BulkIndex.__cache__.move_to_end(key)
+                return BulkIndex.__cache__[key]
+        result = BulkIndex.__read_sidecar__(index_file, stat, max_offset) if sidecar else None
+        if result is None:
+            with open(index_file, 'rb') as fobj:
+                result = BulkIndex.parse(fobj, max_offset)
+            if sidecar:
+                BulkIndex.__write_sidecar__(index_file, result)
+        with BulkIndex.__cache_lock__:
+            BulkIndex.__cache__[key] = result
+            while len(BulkIndex.__cache__) > BulkIndex.cache_size:
+                BulkIndex.__cache__.popitem(last=False)
+        return result
+
+    @staticmethod
+    def clear_cache():
+        """
+        Drop all cached indexes.
+        """
+        with BulkIndex.__cache_lock__:
+            BulkIndex.__cache__.clear()
+
+    @staticmethod
+    def sidecar_path(index_file):
+        """
+        :param index_file: path of the .index.gz file
+        :return: path of the binary sidecar for the index file
+        """
+        return os.path.splitext(index_file)[0] + ".npy"
+
+    @staticmethod
+    def __read_sidecar__(index_file, stat, max_offset):
+        path = BulkIndex.sidecar_path(index_file)
+        try:
+            if os.stat(path).st_mtime_ns < stat.st_mtime_ns:
+                return None
+            data = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        if data.dtype != __sidecar_dtype__:
+            return None
+        return BulkIndex(data['type_id'], data['start'], max_offset)
+
+    @staticmethod
+    def __write_sidecar__(index_file, index):
+        data = np.empty(len(index.type_id), dtype=__sidecar_dtype__)
+        data['type_id'] = index.type_id
+        data['start'] = index.start
+        path = BulkIndex.sidecar_path(index_file)
+        try:
+            # Write through a file object so np.save does not append another .npy suffix
+            with open(path + ".tmp", 'wb') as fobj:
+                np.save(fobj, data, allow_pickle=False)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            # Sidecars are an optimization only, e.g. local storage may be read-only
+            pass
+
+    def locate(self, types):
+        """
+        Vectorized lookup.
+
+        :param types: array-like of type IDs
+        :return: (found, start, end) arrays aligned with types.  start and end are -1 where found is False.
+        """
+        types = np.asarray(types, dtype=np.int64)
+        if len(self.__sorted_type__) == 0:
+            return np.zeros(len(types), dtype=bool), np.full(len(types), -1), np.full(len(types), -1)
+        pos = np.minimum(np.searchsorted(self.__sorted_type__, types), len(self.__sorted_type__) - 1)
+        found = self.__sorted_type__[pos] == types
+        index = self.__sorted_pos__[pos]
+        return found, np.where(found, self.start[index], -1), np.where(found, self.end[index], -1)
+
+    def __find__(self, type_id):
+        pos = np.searchsorted(self.__sorted_type__, type_id)
+        if pos < len(self.__sorted_type__) and self.__sorted_type__[pos] == type_id:
+            return int(self.__sorted_pos__[pos])
+        return -1
+
+    def __contains__(self, type_id):
+        return self.__find__(type_id) >= 0
+
+    def __getitem__(self, type_id):
+        pos = self.__find__(type_id)
+        if pos < 0:
+            raise KeyError(type_id)
+        return int(self.start[pos]), int(self.end[pos])
+
+    def __len__(self):
+        return len(self.__sorted_type__)
+
+    def keys(self):
+        """
+        :return: list of type IDs in bulk file order
+        """
+        return [int(self.type_id[x]) for x in np.sort(self.__sorted_pos__)]
+
+    def items(self):
+        """
+        :return: list of (type ID, (start, end)) in bulk file order
+        """
+        return [(int(self.type_id[x]), (int(self.start[x]), int(self.end[x]))) for x in np.sort(self.__sorted_pos__)]
+
+    def __str__(self):
+        return "BulkIndex[%d types, max_offset=%d]" % (len(self), self.max_offset)
+
+    def __repr__(self):
+        return str(self)
+
+
+__region_dtype__ = np.dtype([('type_id', '<i8'), ('snapshot_count', '<i8'), ('region_id', '<i8'), ('start', '<i8'),
+                             ('end', '<i8')])
+
+
+class RegionIndex:
+    """
+    Secondary index for an interval bulk file giving, for each (type, region), the byte range of the region
+    within the decompressed type block.  This lets readers decompress a type block only as far as the
+    last wanted region and parse just the wanted regions.  Region indexes are stored next to the bulk file
+    as interval_YYYYMMDD_5.regions.npy and are built by OrderBook.index_regions.
+    """
+    __cache__ = OrderedDict()
+    __cache_lock__ = threading.Lock()
+
+    def __init__(self, table):
+        """
+        :param table: structured array of (type_id, snapshot_count, region_id, start, end) rows, grouped by type
+        """
+        self.table = table
+        self.__types__, self.__first__, self.__count__ = np.unique(table['type_id'], return_index=True,
+                                                                   return_counts=True)
+
+    @staticmethod
+    def from_blocks(blocks):
+        """
+        Create a region index.
+
+        :param blocks: iterable of block_region_offsets results, one per type block
+        :return: new RegionIndex
+        """
+        rows = [(type_id, snapshot_count, region_id, start, end)
+                for type_id, snapshot_count, regions in blocks for region_id, start, end in regions]
+        return RegionIndex(np.array(rows, dtype=__region_dtype__))
+
+    @staticmethod
+    def path_for(bulk_file):
+        """
+        :param bulk_file: path of an interval bulk file
+        :return: path of the region index for the bulk file
+        """
+        return os.path.splitext(bulk_file)[0] + ".regions.npy"
+
+    def write(self, path):
+        """
+        Save this index.
+
+        :param path: path to write to
+        """
+        with open(path + ".tmp", 'wb') as fobj:
+            np.save(fobj, self.table, allow_pickle=False)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(bulk_file):
+        """
+        Load the region index for a bulk file through an in-process cache.
+
+        :param bulk_file: path of an interval bulk file
+        :return: RegionIndex, or None if there is no region index at least as new as the bulk file
+        """
+        path = RegionIndex.path_for(bulk_file)
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime_ns < os.stat(bulk_file).st_mtime_ns:
+                return None
+        except OSError:
+            return None
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with RegionIndex.__cache_lock__:
+            if key in RegionIndex.__cache__:
+                RegionIndex.__cache__.move_to_end(key)
+                return RegionIndex.__cache__[key]
+        try:
+            table = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        if table.dtype != __region_dtype__:
+            return None
+        result = RegionIndex(table)
+        with RegionIndex.__cache_lock__:
+            RegionIndex.__cache__[key] = result
+            while len(RegionIndex.__cache__) > BulkIndex.cache_size:
+                RegionIndex.__cache__.popitem(last=False)
+        return result
+
+    def slices(self, type_id, region_id):
+        """
+        Look up the wanted regions of a type.
+
+        :param type_id: type to look up
+        :param region_id: set of wanted region IDs
+        :return: tuple (type_id, snapshot_count, list of (start, end)) in block order suitable for
+                 parse_region_slices, or None if the type is not indexed
+        """
+        pos = np.searchsorted(self.__types__, type_id)
+        if pos >= len(self.__types__) or self.__types__[pos] != type_id:
+            return None
+        rows = self.table[self.__first__[pos]:self.__first__[pos] + self.__count__[pos]]
+        wanted = rows[np.isin(rows['region_id'], np.fromiter(region_id, dtype=np.int64))]
+        return type_id, int(rows['snapshot_count'][0]), [(int(x['start']), int(x['end'])) for x in wanted]
+
+    def __str__(self):
+        return "RegionIndex[%d types, %d regions]" % (len(self.__types__), len(self.table))
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,787 @@
+# evekit.marketdata.ColumnarOrderBook module
+"""
+Columnar (NumPy-backed) order book representation.  Instead of one MarketOrder object per order
+per snapshot, each (type, region) pair stores all of its orders for the day in a single packed
+structured array, plus small per-snapshot arrays giving the snapshot time, the start offset of
+each snapshot in the order array, and the number of bids in each snapshot.  Within a snapshot,
+bids come first followed by asks, in the same order they appear in the source data.
+"""
+import io
+import mmap
+import zlib
+from collections import deque
+from itertools import islice, chain
+import numpy as np
+import pandas as pd
+from evekit.util import convert_raw_time
+from .price_ladder import PriceLadder
+
+ORDER_DTYPE = np.dtype([('order_id', '<i8'),
+                        ('buy', '?'),
+                        ('issued', '<i8'),
+                        ('price', '<f8'),
+                        ('volume_entered', '<i8'),
+                        ('min_volume', '<i8'),
+                        ('volume', '<i8'),
+                        ('order_range', 'i1'),
+                        ('location_id', '<i8'),
+                        ('duration', '<i4')])
+"""
+Packed layout of a single order (62 bytes).  Issue time is stored as raw milliseconds UTC since the epoch.
+Order range is stored as an integer code, see encode_order_range.
+"""
+
+ORDER_RANGE_STATION = -1
+ORDER_RANGE_SOLARSYSTEM = 0
+ORDER_RANGE_REGION = 127
+__named_ranges__ = {'station': ORDER_RANGE_STATION,
+                    'solarsystem': ORDER_RANGE_SOLARSYSTEM,
+                    'region': ORDER_RANGE_REGION}
+__range_names__ = {v: k for k, v in __named_ranges__.items()}
+
+
+def encode_order_range(order_range):
+    """
+    Encode an order range string as an integer code.  Numeric ranges are stored as the
+    jump count, the named ranges 'station', 'solarsystem' and 'region' use the codes
+    ORDER_RANGE_STATION, ORDER_RANGE_SOLARSYSTEM and ORDER_RANGE_REGION.
+
+    :param order_range: order range string
+    :return: integer code for order range
+    """
+    if order_range in __named_ranges__:
+        return __named_ranges__[order_range]
+    jumps = int(order_range)
+    if jumps <= ORDER_RANGE_SOLARSYSTEM or jumps >= ORDER_RANGE_REGION:
+        raise Exception("Unsupported order range: %s" % order_range)
+    return jumps
+
+
+def decode_order_range(code):
+    """
+    Decode an integer order range code back to the order range string.
+
+    :param code: integer code as produced by encode_order_range
+    :return: order range string
+    """
+    code = int(code)
+    return __range_names__.get(code, str(code))
+
+
+def encode_order_ranges(values):
+    """
+    Vectorized version of encode_order_range.
+
+    :param values: array-like of order range strings
+    :return: array of order range codes with dtype int8
+    """
+    uniques, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    codes = np.array([encode_order_range(x) for x in uniques], dtype=np.int8)
+    return codes[inverse.reshape(-1)]
+
+
+def decode_order_ranges(codes):
+    """
+    Vectorized version of decode_order_range.
+
+    :param codes: array-like of order range codes
+    :return: object array of order range strings
+    """
+    uniques, inverse = np.unique(np.asarray(codes), return_inverse=True)
+    names = np.array([decode_order_range(x) for x in uniques], dtype=object)
+    return names[inverse.reshape(-1)]
+
+
+class SnapshotColumns:
+    """
+    All snapshots for a single (type, region) pair in columnar form.
+
+    snapshot_time - int64 array of snapshot times in milliseconds UTC since the epoch
+    bid_count - int32 array giving the number of bids in each snapshot
+    offsets - int64 array of length len(snapshot_time) + 1.  Orders for snapshot i are
+              orders[offsets[i]:offsets[i + 1]], with bids first.
+    orders - structured array with dtype ORDER_DTYPE
+    """
+    def __init__(self, snapshot_time, bid_count, offsets, orders):
+        self.snapshot_time = snapshot_time
+        self.bid_count = bid_count
+        self.offsets = offsets
+        self.orders = orders
+
+    @staticmethod
+    def from_counts(snapshot_time, bid_count, ask_count, orders):
+        """
+        Create columns from per-snapshot bid and ask counts.
+
+        :param snapshot_time: array-like of snapshot times in milliseconds UTC
+        :param bid_count: array-like of bid counts per snapshot
+        :param ask_count: array-like of ask counts per snapshot
+        :param orders: structured array of orders with dtype ORDER_DTYPE
+        :return: new SnapshotColumns
+        """
+        bid_count = np.asarray(bid_count, dtype=np.int32)
+        counts = bid_count.astype(np.int64) + np.asarray(ask_count, dtype=np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if offsets[-1] != len(orders):
+            raise Exception("Snapshot counts do not match order count: %d != %d" % (offsets[-1], len(orders)))
+        return SnapshotColumns(np.asarray(snapshot_time, dtype=np.int64), bid_count, offsets, orders)
+
+    def __len__(self):
+        return len(self.snapshot_time)
+
+    @property
+    def ask_count(self):
+        return (np.diff(self.offsets) - self.bid_count).astype(np.int32)
+
+    @property
+    def nbytes(self):
+        return self.snapshot_time.nbytes + self.bid_count.nbytes + self.offsets.nbytes + self.orders.nbytes
+
+    def snapshot_datetime(self, i):
+        return convert_raw_time(int(self.snapshot_time[i]))
+
+    def bids(self, i):
+        """
+        Bids for snapshot i (a view into the order array).
+        """
+        start = self.offsets[i]
+        return self.orders[start:start + self.bid_count[i]]
+
+    def asks(self, i):
+        """
+        Asks for snapshot i (a view into the order array).
+        """
+        return self.orders[self.offsets[i] + self.bid_count[i]:self.offsets[i + 1]]
+
+    def snapshot_orders(self, i):
+        """
+        All orders for snapshot i (a view into the order array), bids first.
+        """
+        return self.orders[self.offsets[i]:self.offsets[i + 1]]
+
+    def snapshot_index(self):
+        """
+        :return: array giving the snapshot index of each order in the order array
+        """
+        return np.repeat(np.arange(len(self.snapshot_time)), np.diff(self.offsets))
+
+    def ladder(self, i, buy, location=None):
+        """
+        Create a price ladder for one side of snapshot i.
+
+        :param i: snapshot index
+        :param buy: True for the bid side, False for the ask side
+        :param location: optional location ID to restrict orders to
+        :return: PriceLadder for the side
+        """
+        return PriceLadder.from_orders(self.bids(i) if buy else self.asks(i), buy, location)
+
+
+def fill_gap_columns(columns):
+    """
+    Backfill gapped orders in columnar snapshots.  An order which appears in snapshot k, is missing
+    from snapshot k - 1, and was issued before snapshot k - 1 is copied into snapshots k - 1, k - 2, ...
+    until reaching a snapshot which already contains the order or which precedes the issue time.  The
+    copies are placed as OrderBook.fill_gaps would place them: before the first order on the same
+    side with a worse price, and after any orders already backfilled with the same or better price.
+
+    All fill ranges are found from a single sort of the orders by (order ID, snapshot), and all
+    copies are placed by a single sort, so the cost is O(n log n) in the number of orders.
+
+    :param columns: SnapshotColumns to fill
+    :return: new SnapshotColumns with gaps filled, or columns if there were no gaps
+    """
+    orders = columns.orders
+    times = columns.snapshot_time
+    if len(orders) == 0:
+        return columns
+    snap = columns.snapshot_index()
+    # Previous snapshot containing each order, if any
+    by_id = np.lexsort((snap, orders['order_id']))
+    sorted_ids = orders['order_id'][by_id]
+    sorted_snap = snap[by_id]
+    prev_snap = np.full(len(orders), -1, dtype=np.int64)
+    same = sorted_ids[1:] == sorted_ids[:-1]
+    prev_snap[1:][same] = sorted_snap[:-1][same]
+    # Orders missing from the previous snapshot and issued before it
+    gapped = prev_snap < sorted_snap - 1
+    rows = by_id[gapped]
+    last = sorted_snap[gapped] - 1
+    first = prev_snap[gapped] + 1
+    issued = orders['issued'][rows]
+    gapped = issued < times[last]
+    rows = rows[gapped]
+    last = last[gapped]
+    first = np.maximum(first[gapped], np.searchsorted(times, issued[gapped], side='left'))
+    copy_count = np.maximum(last - first + 1, 0)
+    total = int(copy_count.sum())
+    if total == 0:
+        return columns
+    source = np.repeat(rows, copy_count)
+    group_start = np.repeat(np.cumsum(copy_count) - copy_count, copy_count)
+    target = np.repeat(first, copy_count) + (np.arange(total) - group_start)
+    # Blocks are (snapshot, side) pairs numbered so that bids precede asks within a snapshot
+    position = np.arange(len(orders)) - columns.offsets[snap]
+    is_ask = position >= columns.bid_count[snap]
+    block = 2 * snap + is_ask
+    position[is_ask] -= columns.bid_count[snap[is_ask]]
+    copy_ask = ~orders['buy'][source]
+    copy_block = 2 * target + copy_ask
+    # Both sides are searched in ascending key order
+    key = np.where(is_ask, orders['price'], -orders['price'])
+    copy_key = np.where(copy_ask, orders['price'][source], -orders['price'][source])
+    # A copy is placed before the first resting order with a worse price, i.e. before the first
+    # order whose running maximum key in the block exceeds the copy key.
+    running_max = pd.Series(key).groupby(block).cummax().to_numpy()
+    merged = np.lexsort((np.r_[np.zeros(len(orders), dtype=np.int8), np.ones(total, dtype=np.int8)],
+                         np.r_[running_max, copy_key], np.r_[block, copy_block]))
+    resting_before = np.cumsum(merged < len(orders))
+    copy_rank = np.empty(total, dtype=np.int64)
+    copy_rank[merged[merged >= len(orders)] - len(orders)] = resting_before[merged >= len(orders)]
+    copy_gap = copy_rank - np.searchsorted(block, copy_block, side='left')
+    # Final placement.  Copies landing in the same gap are ordered by key, then by the order in
+    # which OrderBook.fill_gaps would have inserted them.
+    final = np.lexsort((np.r_[np.arange(len(orders)), source],
+                        np.r_[np.zeros(len(orders)), copy_key],
+                        np.r_[2 * position + 1, 2 * copy_gap],
+                        np.r_[block, copy_block]))
+    all_block = np.r_[block, copy_block]
+    block_count = np.bincount(all_block, minlength=2 * len(times))
+    return SnapshotColumns.from_counts(times, block_count[0::2], block_count[1::2],
+                                       np.concatenate([orders, orders[source]])[final])
+
+
+class SnapshotDiff:
+    """
+    Changes between two consecutive snapshots of one (type, region) pair.  All order arrays have dtype
+    ORDER_DTYPE.
+
+    previous_time, snapshot_time - times in milliseconds UTC of the earlier and later snapshot
+    new - orders in the later snapshot which are not in the earlier snapshot, in later snapshot order
+    removed - orders in the earlier snapshot which are not in the later snapshot, in earlier snapshot order
+    price_changed - tuple (before, after) of aligned arrays for orders present in both snapshots whose price
+                    changed, in earlier snapshot order
+    volume_changed - tuple (before, after) of aligned arrays for orders present in both snapshots whose
+                     volume changed, in earlier snapshot order
+    """
+    def __init__(self, type_id, region_id, previous_time, snapshot_time, new, removed, price_changed,
+                 volume_changed):
+        self.type_id = type_id
+        self.region_id = region_id
+        self.previous_time = previous_time
+        self.snapshot_time = snapshot_time
+        self.new = new
+        self.removed = removed
+        self.price_changed = price_changed
+        self.volume_changed = volume_changed
+
+    @property
+    def snapshot_datetime(self):
+        return convert_raw_time(int(self.snapshot_time))
+
+    def __str__(self):
+        return "SnapshotDiff[%d, %d, %s, new=%d, removed=%d, price_changed=%d, volume_changed=%d]" % \
+               (self.type_id, self.region_id, self.snapshot_datetime, len(self.new), len(self.removed),
+                len(self.price_changed[0]), len(self.volume_changed[0]))
+
+    def __repr__(self):
+        return str(self)
+
+
+def match_snapshot_orders(columns):
+    """
+    Match orders between each pair of consecutive snapshots.  Orders are matched by order ID in a single
+    pass over all snapshots sorted by (order ID, snapshot).  If an order ID appears more than once in a
+    snapshot, only the first occurrence is used.
+
+    :param columns: SnapshotColumns to match
+    :return: tuple (added, removed, before, after) of positions in columns.orders.  added holds orders
+             not present in the previous snapshot (excluding the first snapshot), removed holds orders not
+             present in the next snapshot (excluding the last snapshot), both in order array order.  before
+             and after are aligned positions of the same order in consecutive snapshots, in order array order
+             of before.
+    """
+    count = len(columns)
+    orders = columns.orders
+    snap = columns.snapshot_index()
+    order_id = orders['order_id']
+    # Sort by ID, then snapshot, then position, and keep the first occurrence of each ID in each snapshot
+    order = np.lexsort((np.arange(len(orders)), snap, order_id))
+    sorted_snap = snap[order]
+    sorted_id = order_id[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sorted_id[1:] != sorted_id[:-1]) | (sorted_snap[1:] != sorted_snap[:-1])
+    order = order[first]
+    sorted_snap = sorted_snap[first]
+    sorted_id = sorted_id[first]
+    # An entry is matched when the next entry is the same ID in the following snapshot
+    matched = np.zeros(len(order), dtype=bool)
+    matched[:-1] = (sorted_id[1:] == sorted_id[:-1]) & (sorted_snap[1:] == sorted_snap[:-1] + 1)
+    matched_prev = np.zeros(len(order), dtype=bool)
+    matched_prev[1:] = matched[:-1]
+    # Sorting row positions puts results in snapshot order and book order within each snapshot
+    removed = np.sort(order[~matched & (sorted_snap < count - 1)])
+    added = np.sort(order[~matched_prev & (sorted_snap > 0)])
+    before = order[:-1][matched[:-1]]
+    after = order[1:][matched[:-1]]
+    position = np.argsort(before)
+    return added, removed, before[position], after[position]
+
+
+def snapshot_diffs(columns, type_id=-1, region_id=-1):
+    """
+    Compute the changes between each pair of consecutive snapshots using match_snapshot_orders.
+
+    :param columns: SnapshotColumns to diff
+    :param type_id: type ID to record in the results
+    :param region_id: region ID to record in the results
+    :return: generator yielding a SnapshotDiff for each consecutive pair of snapshots
+    """
+    count = len(columns)
+    if count < 2:
+        return
+    orders = columns.orders
+    snap = columns.snapshot_index()
+    added, removed, before, after = match_snapshot_orders(columns)
+    price_change = orders['price'][before] != orders['price'][after]
+    volume_change = orders['volume'][before] != orders['volume'][after]
+    price_before, price_after = before[price_change], after[price_change]
+    volume_before, volume_after = before[volume_change], after[volume_change]
+    # Split everything by pair index, which is the snapshot index of the earlier snapshot
+    pairs = np.arange(count)
+    removed_split = np.searchsorted(snap[removed], pairs)
+    added_split = np.searchsorted(snap[added] - 1, pairs)
+    price_split = np.searchsorted(snap[price_before], pairs)
+    volume_split = np.searchsorted(snap[volume_before], pairs)
+    for i in range(count - 1):
+        yield SnapshotDiff(type_id, region_id, columns.snapshot_time[i], columns.snapshot_time[i + 1],
+                           orders[added[added_split[i]:added_split[i + 1]]],
+                           orders[removed[removed_split[i]:removed_split[i + 1]]],
+                           (orders[price_before[price_split[i]:price_split[i + 1]]],
+                            orders[price_after[price_split[i]:price_split[i + 1]]]),
+                           (orders[volume_before[volume_split[i]:volume_split[i + 1]]],
+                            orders[volume_after[volume_split[i]:volume_split[i + 1]]]))
+
+
+def top_of_book_columns(columns, location=None):
+    """
+    Compute the best bid and ask for each snapshot.
+
+    :param columns: SnapshotColumns to reduce
+    :param location: optional location ID, or array-like of location IDs, to restrict orders to
+    :return: map from column name to per-snapshot array: bid_price, bid_volume, ask_price, ask_volume.  Prices
+             are NaN and volumes 0 for snapshots with no orders on a side.  Volumes are the total volume of all
+             orders at the best price.
+    """
+    count = len(columns)
+    orders = columns.orders
+    snap = columns.snapshot_index()
+    keep = np.ones(len(orders), dtype=bool) if location is None else \
+        np.isin(orders['location_id'], np.atleast_1d(np.asarray(location, dtype=np.int64)))
+    result = {}
+    for side, buy, reduce, empty in (('bid', True, np.maximum, -np.inf), ('ask', False, np.minimum, np.inf)):
+        selected = keep & (orders['buy'] == buy)
+        side_snap = snap[selected]
+        side_price = orders['price'][selected]
+        best = np.full(count, empty)
+        reduce.at(best, side_snap, side_price)
+        at_best = side_price == best[side_snap]
+        volume = np.bincount(side_snap[at_best], weights=orders['volume'][selected][at_best], minlength=count)
+        best[best == empty] = np.nan
+        result[side + '_price'] = best
+        result[side + '_volume'] = volume.astype(np.int64)
+    return result
+
+
+class ColumnarOrderBook:
+    """
+    Columnar equivalent of OrderBook.  The region attribute maps region ID to a SnapshotColumns
+    object instead of a list of MarketSnapshot.
+    """
+    def __init__(self, dt, size=5, ps=None, region_id=None):
+        """
+        Initialize order book from stream (if present).
+
+        :param dt: datetime for day represented by order book
+        :param size: interval size in minutes
+        :param ps: optional character stream to read data from
+        :param region_id: optional set of region IDs to include.  If None, then include all regions contained
+                          in the stream.
+        """
+        self.date = dt
+        self.interval_size = size
+        self.region = {}
+        if ps is None:
+            return
+        self.__load_block__(ps.read(), region_id)
+
+    def __load_block__(self, data, region_id=None):
+        self.type_id, self.region = parse_book_block(data, region_id)
+
+    @staticmethod
+    def from_block(dt, data, size=5, region_id=None):
+        """
+        Create an order book from a decompressed type block of an interval bulk file.
+
+        :param dt: datetime for day represented by order book
+        :param data: decompressed type block (bytes-like)
+        :param size: interval size in minutes
+        :param region_id: optional set of region IDs to include.  If None, then include all regions contained
+                          in the block.
+        :return: a new ColumnarOrderBook
+        """
+        book = ColumnarOrderBook(dt, size)
+        book.__load_block__(data, region_id)
+        return book
+
+    @property
+    def nbytes(self):
+        return sum([x.nbytes for x in self.region.values()])
+
+    def fill_gaps(self):
+        """
+        Look for order gapping and backfill to fix.  This produces the same books as OrderBook.fill_gaps
+        but works directly on the order arrays.
+        """
+        for region_id in self.region.keys():
+            self.region[region_id] = fill_gap_columns(self.region[region_id])
+
+    def diffs(self, region_id=None):
+        """
+        Compute changes between consecutive snapshots.
+
+        :param region_id: optional set of region IDs to diff.  If None, then diff all regions.
+        :return: generator yielding a SnapshotDiff for each consecutive pair of snapshots, region by region
+        """
+        for next_region in self.region.keys():
+            if region_id is None or next_region in region_id:
+                yield from snapshot_diffs(self.region[next_region], self.type_id, next_region)
+
+    def __str__(self):
+        result = "ColumnarOrderBook[date=%s, intervalSize=%d, typeID=%d,\n" % (self.date, self.interval_size,
+                                                                              self.type_id)
+        for region in self.region.keys():
+            columns = self.region[region]
+            result += "regionID=%d: snapshots=%d, orders=%d\n" % (region, len(columns), len(columns.orders))
+        result += "]"
+        return result
+
+    def __repr__(self):
+        return str(self)
+
+
+__order_columns__ = ['order_id', 'buy', 'issued', 'price', 'volume_entered', 'min_volume', 'volume',
+                     'order_range', 'location_id', 'duration']
+__csv_dtypes__ = {'order_id': np.int64, 'buy': bool, 'issued': np.int64, 'price': np.float64,
+                  'volume_entered': np.int64, 'min_volume': np.int64, 'volume': np.int64,
+                  'order_range': 'category', 'location_id': np.int64, 'duration': np.int32}
+
+
+def parse_orders(lines):
+    """
+    Parse order lines into a structured array.  Most orders are unchanged from one snapshot to the
+    next, so identical lines are parsed only once, in one pass of the pandas C parser, and then
+    expanded back out.  Prices are parsed with round trip precision so that values are identical
+    to float().
+
+    :param lines: list of order lines (bytes) in interval bulk file format
+    :return: structured array with dtype ORDER_DTYPE
+    """
+    if len(lines) == 0:
+        return np.empty(0, dtype=ORDER_DTYPE)
+    line_index = {}
+    inverse = np.fromiter([line_index.setdefault(x, len(line_index)) for x in lines], dtype=np.int64,
+                          count=len(lines))
+    frame = pd.read_csv(io.BytesIO(b'\n'.join(line_index.keys())), header=None, names=__order_columns__,
+                        dtype=__csv_dtypes__, true_values=['true', 'True'], false_values=['false', 'False'],
+                        float_precision='round_trip', engine='c')
+    distinct = np.empty(len(frame), dtype=ORDER_DTYPE)
+    for name in __order_columns__:
+        if name == 'order_range':
+            ranges = frame[name].array
+            codes = np.array([encode_order_range(x) for x in ranges.categories], dtype=np.int8)
+            distinct[name] = codes[ranges.codes]
+        else:
+            distinct[name] = frame[name].to_numpy()
+    return distinct[inverse]
+
+
+def parse_book_block(data, region_id=None):
+    """
+    Parse a decompressed type block from an interval bulk file.  The block is split into lines once,
+    header lines are walked using the snapshot bid and ask counts, and the order lines for all
+    included regions are parsed together by parse_orders.
+
+    :param data: decompressed type block (bytes-like)
+    :param region_id: optional set of region IDs to include.  If None, then include all regions contained
+                      in the block.
+    :return: tuple (type_id, map from region ID to SnapshotColumns)
+    """
+    lines = bytes(data).split(b'\n')
+    type_id = int(lines[0])
+    snapshot_count = int(lines[1])
+    pos = 2
+    line_count = len(lines)
+    kept = []
+    order_lines = []
+    while pos < line_count and len(lines[pos].strip()) > 0:
+        next_region = int(lines[pos])
+        pos += 1
+        keep = region_id is None or next_region in region_id
+        snapshot_time = np.empty(snapshot_count, dtype=np.int64)
+        bid_count = np.empty(snapshot_count, dtype=np.int32)
+        ask_count = np.empty(snapshot_count, dtype=np.int32)
+        for i in range(snapshot_count):
+            snapshot_time[i] = int(lines[pos])
+            bid_count[i] = int(lines[pos + 1])
+            ask_count[i] = int(lines[pos + 2])
+            start = pos + 3
+            pos = start + bid_count[i] + ask_count[i]
+            if keep:
+                order_lines.extend(lines[start:pos])
+        if keep:
+            kept.append((next_region, snapshot_time, bid_count, ask_count))
+            if region_id is not None and len(kept) == len(region_id):
+                # Short circuit, we have all the regions we want
+                break
+    orders = parse_orders(order_lines)
+    result = {}
+    offset = 0
+    for next_region, snapshot_time, bid_count, ask_count in kept:
+        count = int(bid_count.sum(dtype=np.int64) + ask_count.sum(dtype=np.int64))
+        result[next_region] = SnapshotColumns.from_counts(snapshot_time, bid_count, ask_count,
+                                                          orders[offset:offset + count])
+        offset += count
+    return type_id, result
+
+
+def __parse_order__(order_string):
+    vals = order_string.split(b',')
+    return (int(vals[0]), vals[1] == b'true' or vals[1] == b'True', int(vals[2]), float(vals[3]), int(vals[4]),
+            int(vals[5]), int(vals[6]), encode_order_range(vals[7].decode('utf-8')), int(vals[8]), int(vals[9]))
+
+
+def block_region_offsets(data):
+    """
+    Locate the regions of a decompressed type block.
+
+    :param data: decompressed type block (bytes-like)
+    :return: tuple (type_id, snapshot_count, list of (region_id, start, end)) where start is the byte offset
+             of the region line and end is the byte offset just past the last line of the region, in block order
+    """
+    data = bytes(data)
+    lines = data.split(b'\n')
+    # ends[i] is the byte offset just past line i and its terminator
+    ends = np.cumsum(np.fromiter((len(x) + 1 for x in lines), dtype=np.int64, count=len(lines)))
+    type_id = int(lines[0])
+    snapshot_count = int(lines[1])
+    pos = 2
+    line_count = len(lines)
+    regions = []
+    while pos < line_count and len(lines[pos].strip()) > 0:
+        next_region = int(lines[pos])
+        start = int(ends[pos - 1])
+        pos += 1
+        for _ in range(snapshot_count):
+            pos += 3 + int(lines[pos + 1]) + int(lines[pos + 2])
+        regions.append((next_region, start, min(int(ends[pos - 1]), len(data))))
+    return type_id, snapshot_count, regions
+
+
+def decompress_block(data, max_length=None):
+    """
+    Decompress a type block in one shot.  Unlike gzip.decompress, the input is passed straight to
+    zlib, so memoryview slices (e.g. of a memory mapped bulk file) are not copied.
+
+    :param data: compressed type block (bytes-like) holding one or more gzip members
+    :param max_length: if not None, stop decompressing once at least this many bytes have been produced
+    :return: decompressed block as bytes
+    """
+    members = []
+    produced = 0
+    while len(data) > 0:
+        decompressor = zlib.decompressobj(wbits=31)
+        if max_length is None:
+            members.append(decompressor.decompress(data))
+        else:
+            members.append(decompressor.decompress(data, max_length - produced))
+            produced += len(members[-1])
+            if produced >= max_length:
+                break
+        if not decompressor.eof:
+            raise EOFError("Compressed type block ended before the end-of-stream marker was reached")
+        data = decompressor.unused_data.lstrip(b'\x00')
+    return b''.join(members)
+
+
+def parse_region_slices(compressed, region_slices, region_id):
+    """
+    Parse selected regions of a type block located with block_region_offsets.  The block is only
+    decompressed as far as the end of the last wanted region, and only the wanted regions are split
+    and parsed.
+
+    :param compressed: compressed type block (bytes-like)
+    :param region_slices: tuple (type_id, snapshot_count, list of (start, end)) giving the byte ranges of
+                          the wanted regions in the decompressed block, in block order
+    :param region_id: set of region IDs to include
+    :return: tuple (type_id, map from region ID to SnapshotColumns)
+    """
+    type_id, snapshot_count, slices = region_slices
+    if len(slices) == 0:
+        return type_id, {}
+    data = decompress_block(compressed, max([x[1] for x in slices]))
+    header = b'%d\n%d\n' % (type_id, snapshot_count)
+    return parse_book_block(header + b''.join([data[x[0]:x[1]] for x in slices]), region_id)
+
+
+def parse_bulk_range(bulk_file, start, end, region_id=None, region_slices=None):
+    """
+    Decompress and parse a single type block from a local interval bulk file.  This is a module level
+    function so that it can be run in a process pool.
+
+    :param bulk_file: path of the interval bulk file
+    :param start: offset of the first byte of the type block
+    :param end: offset of the last byte of the type block (inclusive)
+    :param region_id: optional set of region IDs to include.  If None, then include all regions.
+    :param region_slices: optional region byte ranges for parse_region_slices
+    :return: (type_id, map from region ID to SnapshotColumns)
+    """
+    with open(bulk_file, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view, view[start:end + 1] as block:
+            if region_slices is not None:
+                return parse_region_slices(block, region_slices, region_id)
+            data = decompress_block(block)
+    return parse_book_block(data, region_id)
+
+
+def __resume_block_lines__(read, size, chunk_size, state):
+    # Decompress a type block from a saved position and yield its lines.  The state map is updated before
+    # each line is yielded, so that it can be saved with __save_block_state__ and resumed later.
+    while True:
+        lines = state['lines']
+        while state['line'] < len(lines):
+            state['line'] += 1
+            yield lines[state['line'] - 1]
+        data = b''
+        while len(data) == 0:
+            decompressor = state['decompressor']
+            if len(state['tail']) == 0 and not state['full']:
+                if state['offset'] >= size:
+                    if len(state['pending']) > 0:
+                        state['lines'] = [state['pending']]
+                        state['line'] = 0
+                        state['pending'] = b''
+                        break
+                    return
+                end = min(state['offset'] + chunk_size, size)
+                state['tail'] = read(state['offset'], end)
+                state['offset'] = end
+            data = decompressor.decompress(state['tail'], chunk_size)
+            # A full output buffer may leave decompressed data inside the decompressor
+            state['full'] = len(data) == chunk_size
+            state['tail'] = decompressor.unconsumed_tail
+            if decompressor.eof:
+                # Start of next gzip member, if any
+                state['tail'] = decompressor.unused_data
+                state['decompressor'] = zlib.decompressobj(wbits=31)
+                state['full'] = False
+        if len(data) > 0:
+            lines = (state['pending'] + data).split(b'\n')
+            state['pending'] = lines.pop()
+            state['lines'] = lines
+            state['line'] = 0
+
+
+def __save_block_state__(state):
+    return dict(state, decompressor=state['decompressor'].copy(), lines=state['lines'][state['line']:], line=0)
+
+
+def split_block_regions(read, size, region_id=None, chunk_size=1 << 16):
+    """
+    Split a compressed type block into one line iterator per region.  Regions are stored one after
+    another in a block, so the block is scanned once, without parsing orders, to find the start of each
+    wanted region, and the decompressor state is saved there.  The lines of each region are then
+    decompressed from its saved state as they are requested.  However many regions are wanted, the
+    block is decompressed about twice, and only one chunk of compressed and decompressed data is held
+    per region at a time.
+
+    :param read: function taking (start, end) and returning bytes [start, end) of the compressed block.
+                 The block may hold one or more gzip members.
+    :param size: size of the compressed block in bytes
+    :param region_id: optional set of region IDs to include.  If None, then include all regions contained
+                      in the block.
+    :param chunk_size: number of compressed bytes read, and maximum number of bytes decompressed, at a time
+    :return: list of tuples (region_id, lines) in block order, where lines is a generator over the lines
+             of a type block holding just that region, suitable for iter_block_snapshots
+    """
+    state = {'offset': 0, 'tail': b'', 'full': False, 'decompressor': zlib.decompressobj(wbits=31),
+             'lines': [], 'line': 0, 'pending': b''}
+    lines = __resume_block_lines__(read, size, chunk_size, state)
+    header = [next(lines), next(lines)]
+    snapshot_count = int(header[1])
+    remaining = None if region_id is None else set(region_id)
+    regions = []
+    for next_region in lines:
+        if len(next_region.strip()) == 0:
+            break
+        if remaining is None or int(next_region) in remaining:
+            regions.append((int(next_region), header + [next_region], __save_block_state__(state)))
+            if remaining is not None:
+                remaining.discard(int(next_region))
+                if len(remaining) == 0:
+                    # Short circuit, we have found all the regions we want
+                    break
+        for i in range(snapshot_count):
+            next(lines)
+            order_count = int(next(lines)) + int(next(lines))
+            deque(islice(lines, order_count), maxlen=0)
+    lines.close()
+    return [(x[0], chain(x[1], __resume_block_lines__(read, size, chunk_size, x[2]))) for x in regions]
+
+
+def iter_block_snapshots(lines, region_id=None):
+    """
+    Parse the lines of a type block one snapshot at a time.  Orders unchanged from the previous
+    snapshot of the same region are not re-parsed, so only one snapshot of parsed orders is held
+    at a time.  Regions which are not included are skipped without parsing.
+
+    :param lines: iterable of lines of a type block, e.g. as produced by split_block_regions
+    :param region_id: optional set of region IDs to include.  If None, then include all regions contained
+                      in the block.
+    :return: generator yielding tuples (type_id, region_id, SnapshotColumns) where each SnapshotColumns
+             holds a single snapshot
+    """
+    lines = iter(lines)
+    type_id = int(next(lines))
+    snapshot_count = int(next(lines))
+    remaining = None if region_id is None else set(region_id)
+    for next_region in lines:
+        if len(next_region.strip()) == 0:
+            break
+        next_region = int(next_region)
+        keep = remaining is None or next_region in remaining
+        last_rows = {}
+        for i in range(snapshot_count):
+            raw_time = int(next(lines))
+            bid_count = int(next(lines))
+            ask_count = int(next(lines))
+            if not keep:
+                deque(islice(lines, bid_count + ask_count), maxlen=0)
+                continue
+            rows = []
+            next_rows = {}
+            for next_line in islice(lines, bid_count + ask_count):
+                row = last_rows.get(next_line)
+                if row is None:
+                    row = __parse_order__(next_line)
+                next_rows[next_line] = row
+                rows.append(row)
+            last_rows = next_rows
+            yield type_id, next_region, SnapshotColumns.from_counts([raw_time], [bid_count], [ask_count],
+                                                                    np.array(rows, dtype=ORDER_DTYPE))
+        if remaining is not None and keep:
+            remaining.discard(next_region)
+            if len(remaining) == 0:
+                # Short circuit, we have all the regions we want
+                return
@@ -0,0 +1,63 @@
+# evekit.marketdata.DayLoader module
+"""
+Load independent days of market data concurrently while returning results in date order.
+"""
+import concurrent.futures
+import pickle
+
+
+def load_days(dates, loader, args=(), max_inflight_days=1, max_memory=None, size_of=None, pool='process'):
+    """
+    Call loader(date, *args) for each date and yield the results in date order.  Up to max_inflight_days
+    dates are loaded at once.  If max_memory is given, the first date is loaded on its own to estimate the
+    size of a day, then a new date is only started when the number of dates in flight times the largest
+    result seen so far (as measured by size_of) fits in max_memory.  At least one date is always in flight
+    so loading never stalls.
+
+    :param dates: array-like of dates to load
+    :param loader: function to call for each date.  For a process pool this must be picklable, e.g. a module
+                   level function or static method.
+    :param args: extra arguments passed to loader after the date
+    :param max_inflight_days: maximum number of dates loaded concurrently.  If 1, dates are loaded in the
+                              calling thread.
+    :param max_memory: optional approximate bound in bytes on memory used by dates being loaded
+    :param size_of: function estimating the size in bytes of a loader result.  Required for max_memory.
+    :param pool: 'process' to load in a process pool, or 'thread' to load in a thread pool.  If the loader or
+                 args can't be pickled (e.g. they hold a ServicePool or BookCache, which are shared between
+                 threads), then a thread pool is used instead.
+    :return: generator yielding (date, result) tuples in date order
+    """
+    if max_inflight_days <= 1 or len(dates) <= 1:
+        for next_date in dates:
+            yield next_date, loader(next_date, *args)
+        return
+    if pool not in ('process', 'thread'):
+        raise Exception("Unknown pool type: %s" % pool)
+    if pool == 'process':
+        try:
+            pickle.dumps((loader, args))
+        except (TypeError, AttributeError, pickle.PicklingError):
+            pool = 'thread'
+    executor_class = concurrent.futures.ProcessPoolExecutor if pool == 'process' else \
+        concurrent.futures.ThreadPoolExecutor
+    pending = list(dates)
+    pending.reverse()
+    inflight = []
+    largest = None
+    executor = executor_class(max_workers=max_inflight_days)
+    try:
+        while len(pending) > 0 or len(inflight) > 0:
+            # Admit as many new dates as the limits allow
+            while len(pending) > 0 and len(inflight) < max_inflight_days:
+                if len(inflight) > 0 and max_memory is not None and \
+                        (largest is None or (len(inflight) + 1) * largest > max_memory):
+                    break
+                next_date = pending.pop()
+                inflight.append((next_date, executor.submit(loader, next_date, *args)))
+            next_date, future = inflight.pop(0)
+            result = future.result()
+            if size_of is not None:
+                largest = size_of(result) if largest is None else max(largest, size_of(result))
+            yield next_date, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,428 @@
+# evekit.marketdata.HistoryStore module
+"""
+Consolidated on-disk store of market history for long-range queries.  Market history bulk files are
+date-major, so a query over many days opens and scans one file per day.  A history store holds the same
+rows type-major: the rows of each (type, region) series are contiguous and in date order, and a series
+table gives the location of each series, so a query reads only the series it needs from memory mapped
+columns with no decompression or parsing.
+
+A store is a directory of segment files.  Each append of new days writes a new segment, and compact
+merges all segments into one.  The merged segment lists the segments it supersedes, so if compact is
+interrupted before the old segments are removed, they are ignored (and removed) when the store is next
+opened.  Segment file layout (all values are little-endian 8 byte integers or doubles):
+
+  magic (8 bytes)
+  columns - one array per column in __store_columns__ order, each holding one value per row.  Rows are
+            sorted by type, region and date.
+  series table - one (type_id, region_id, start, count) record per series, sorted by type and region
+  day table - days covered by the segment, as days since the epoch
+  superseded table - numbers of the segments merged into this one by compact
+  trailer - row count, series table offset, series count, day table offset, day count, superseded table
+            offset, superseded count, magic
+"""
+import os
+import mmap
+import struct
+import datetime
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+__store_magic__ = b'EKHIST01'
+
+__trailer__ = struct.Struct('<qqqqqqq8s')
+
+__store_columns__ = (('type_id', np.dtype('<i8')), ('region_id', np.dtype('<i8')), ('order_count', np.dtype('<i8')),
+                     ('low_price', np.dtype('<f8')), ('high_price', np.dtype('<f8')), ('avg_price', np.dtype('<f8')),
+                     ('volume', np.dtype('<i8')), ('date', np.dtype('<i8')), ('day_row', np.dtype('<i8')))
+"""
+Stored columns.  date holds milliseconds since the epoch as in the bulk files.  day_row holds the position of
+the row within the market history of its day, so that rows can be returned in bulk file order.
+"""
+
+__series_dtype__ = np.dtype([('type_id', '<i8'), ('region_id', '<i8'), ('start', '<i8'), ('count', '<i8')])
+
+__day_millis__ = 24 * 60 * 60 * 1000
+
+__epoch_ordinal__ = datetime.date(1970, 1, 1).toordinal()
+
+
+def day_number(date):
+    """
+    :param date: date, datetime or Timestamp
+    :return: days since the epoch for the calendar day of date
+    """
+    return date.toordinal() - __epoch_ordinal__
+
+
+def frame_days(frame):
+    """
+    :param frame: DataFrame of market history with a date column, as returned by MarketHistory.get_day with the
+                  columnar setting
+    :return: array of days since the epoch for each row
+    """
+    values = pd.to_datetime(frame['date'], utc=True).dt.tz_localize(None).to_numpy()
+    return values.astype('datetime64[D]').astype(np.int64)
+
+
+class _HistorySegment:
+    """
+    Read-only view of one memory mapped segment file.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the segment file
+        """
+        self.path = path
+        with open(path, 'rb') as fd:
+            self.__map__ = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.__map__) < len(__store_magic__) + __trailer__.size or \
+                self.__map__[:len(__store_magic__)] != __store_magic__:
+            raise Exception("Not a history store segment: %s" % path)
+        row_count, series_offset, series_count, day_offset, day_count, superseded_offset, superseded_count, magic = \
+            __trailer__.unpack_from(self.__map__, len(self.__map__) - __trailer__.size)
+        if magic != __store_magic__:
+            raise Exception("Truncated history store segment: %s" % path)
+        self.number = int(os.path.basename(path)[8:-5])
+        self.row_count = row_count
+        self.series = np.frombuffer(self.__map__, dtype=__series_dtype__, count=series_count, offset=series_offset)
+        self.days = np.frombuffer(self.__map__, dtype=np.dtype('<i8'), count=day_count, offset=day_offset)
+        self.superseded = np.frombuffer(self.__map__, dtype=np.dtype('<i8'), count=superseded_count,
+                                        offset=superseded_offset).tolist()
+        self.columns = {}
+        for pos, (name, dtype) in enumerate(__store_columns__):
+            self.columns[name] = np.frombuffer(self.__map__, dtype=dtype, count=row_count,
+                                               offset=len(__store_magic__) + pos * 8 * row_count)
+
+    def close(self):
+        """
+        Unmap the segment file.  Arrays previously taken from the segment must no longer be in use.
+        """
+        self.series = None
+        self.days = None
+        self.columns = {}
+        try:
+            self.__map__.close()
+        except BufferError:
+            # A view of the segment is still in use; the map is closed when it is released
+            pass
+
+    def select(self, days, types, regions):
+        """
+        Find the rows for the given days, types and regions.
+
+        :param days: array of days since the epoch, or None for all days
+        :param types: array-like of types, or None for all types
+        :param regions: array-like of regions, or None for all regions
+        :return: array of selected row positions in increasing order
+        """
+        keep = np.ones(len(self.series), dtype=bool)
+        if types is not None:
+            keep &= np.isin(self.series['type_id'], np.asarray(types, dtype=np.int64))
+        if regions is not None:
+            keep &= np.isin(self.series['region_id'], np.asarray(regions, dtype=np.int64))
+        start = self.series['start'][keep]
+        count = self.series['count'][keep]
+        # Expand (start, count) runs into row positions
+        positions = np.repeat(start - np.cumsum(count) + count, count) + np.arange(int(count.sum()), dtype=np.int64)
+        if days is not None:
+            positions = positions[np.isin(self.columns['date'][positions] // __day_millis__, days)]
+        return positions
+
+    @staticmethod
+    def write(path, row_count, chunks, days, superseded=()):
+        """
+        Write a segment file.  The segment is written to a temporary file and renamed into place when complete.
+
+        :param path: path of the segment file to create
+        :param row_count: total number of rows in chunks
+        :param chunks: iterable of maps from column name to array, each sorted by type, region and date and
+                       together giving the rows in store order.  A series may not be split across chunks.
+        :param days: array-like of days since the epoch covered by the segment
+        :param superseded: array-like of numbers of the segments replaced by this one
+        """
+        header = len(__store_magic__)
+        tmp_path = path + ".tmp"
+        series = []
+        written = 0
+        try:
+            with open(tmp_path, 'wb') as fobj:
+                fobj.write(__store_magic__)
+                fobj.truncate(header + 8 * row_count * len(__store_columns__))
+                for next_chunk in chunks:
+                    size = len(next_chunk['type_id'])
+                    if written + size > row_count:
+                        raise Exception("History store segment has more than %d rows" % row_count)
+                    for pos, (name, dtype) in enumerate(__store_columns__):
+                        fobj.seek(header + 8 * (pos * row_count + written))
+                        fobj.write(np.ascontiguousarray(next_chunk[name], dtype=dtype).tobytes())
+                    if size > 0:
+                        type_id = np.asarray(next_chunk['type_id'])
+                        region_id = np.asarray(next_chunk['region_id'])
+                        first = np.flatnonzero(np.concatenate(([True], (type_id[1:] != type_id[:-1]) |
+                                                               (region_id[1:] != region_id[:-1]))))
+                        table = np.empty(len(first), dtype=__series_dtype__)
+                        table['type_id'] = type_id[first]
+                        table['region_id'] = region_id[first]
+                        table['start'] = first + written
+                        table['count'] = np.diff(np.append(first, size))
+                        series.append(table)
+                    written += size
+                if written != row_count:
+                    raise Exception("History store segment has %d rows, expected %d" % (written, row_count))
+                fobj.seek(header + 8 * row_count * len(__store_columns__))
+                series_offset = fobj.tell()
+                series_table = np.concatenate(series) if len(series) > 0 else np.empty(0, dtype=__series_dtype__)
+                fobj.write(series_table.tobytes())
+                day_offset = fobj.tell()
+                day_table = np.unique(np.asarray(days, dtype=np.int64)).astype('<i8')
+                fobj.write(day_table.tobytes())
+                superseded_offset = fobj.tell()
+                superseded_table = np.asarray(superseded, dtype='<i8')
+                fobj.write(superseded_table.tobytes())
+                fobj.write(__trailer__.pack(row_count, series_offset, len(series_table), day_offset, len(day_table),
+                                            superseded_offset, len(superseded_table), __store_magic__))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def __str__(self):
+        return "_HistorySegment[%s, %d rows, %d days]" % (self.path, self.row_count, len(self.days))
+
+    def __repr__(self):
+        return str(self)
+
+
+class HistoryStore:
+    """
+    Consolidated market history store in a directory.  Use MarketHistory.update_store to add days from
+    local storage or the online archive.  MarketHistory.get_data_frame reads days from the store when present.
+    """
+    max_segments = 16
+    """
+    MarketHistory.update_store compacts the store when it has more than this many segments.
+    """
+    chunk_rows = 4 * 1024 * 1024
+    """
+    Approximate number of rows merged at a time by compact.
+    """
+
+    def __init__(self, directory):
+        """
+        Open a history store, creating an empty store if the directory does not exist.
+
+        :param directory: store directory
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        self.__day_set__ = set()
+        self.refresh()
+
+    @staticmethod
+    def store_path(config):
+        """
+        Get the store directory for a reader config.
+
+        :param config: config with optional settings history_store and local_storage as described in
+                       MarketHistory.get_data_frame
+        :return: store directory, or None if no store is configured
+        """
+        value = config.get('history_store', None)
+        if value is None:
+            local_storage_dir = config.get('local_storage', '')
+            if len(local_storage_dir) == 0:
+                return None
+            value = os.path.join(local_storage_dir, 'market_history.store')
+        if value is False:
+            return None
+        return value.directory if isinstance(value, HistoryStore) else value
+
+    @staticmethod
+    def from_config(config):
+        """
+        Get the store to use for a reader config.
+
+        :param config: config with optional settings history_store and local_storage as described in
+                       MarketHistory.get_data_frame
+        :return: the HistoryStore to use, or None if no store is configured or the store does not exist
+        """
+        if isinstance(config.get('history_store', None), HistoryStore):
+            return config['history_store']
+        path = HistoryStore.store_path(config)
+        if path is None or not os.path.isdir(path):
+            return None
+        return HistoryStore(path)
+
+    def refresh(self):
+        """
+        Re-read the list of segments, e.g. after another process has updated the store.
+        """
+        for next_segment in self.segments:
+            next_segment.close()
+        names = sorted([x for x in os.listdir(self.directory) if x.startswith('segment_') and x.endswith('.hist')])
+        segments = [_HistorySegment(os.path.join(self.directory, x)) for x in names]
+        superseded = set()
+        for next_segment in segments:
+            superseded.update(next_segment.superseded)
+        self.segments = []
+        self.__day_set__ = set()
+        for next_segment in segments:
+            if next_segment.number in superseded:
+                # Left behind by an interrupted compact
+                next_segment.close()
+                HistoryStore.__remove__(next_segment.path)
+                continue
+            days = next_segment.days.tolist()
+            overlap = self.__day_set__.intersection(days)
+            if len(overlap) > 0:
+                raise Exception("History store segment %s overlaps other segments on %d days" %
+                                (next_segment.path, len(overlap)))
+            self.__day_set__.update(days)
+            self.segments.append(next_segment)
+
+    @property
+    def days(self):
+        """
+        :return: sorted list of dates in the store
+        """
+        return [datetime.date.fromordinal(x + __epoch_ordinal__) for x in sorted(self.__day_set__)]
+
+    @property
+    def row_count(self):
+        """
+        :return: number of market history rows in the store
+        """
+        return sum([x.row_count for x in self.segments])
+
+    def __contains__(self, date):
+        return day_number(date) in self.__day_set__
+
+    def read(self, dates=None, types=None, regions=None, columns=None, by_day=False):
+        """
+        Read market history from the store.
+
+        :param dates: array-like of dates to read, or None for all dates in the store
+        :param types: array-like of types to read, or None for all types
+        :param regions: array-like of regions to read, or None for all regions
+        :param columns: list of columns to read, or None for all MarketHistory fields.  The day_row column
+                        gives the position of each row in the bulk file for its day.
+        :param by_day: if True, sort rows by date and then in bulk file order, instead of by type, region and date
+        :return: DataFrame of market history.  The date column holds UTC timestamps as returned by
+                 MarketHistory.get_day with the columnar setting.
+        """
+        names = [x[0] for x in __store_columns__ if x[0] != 'day_row'] if columns is None else list(columns)
+        days = None if dates is None else np.unique(np.array([day_number(x) for x in dates], dtype=np.int64))
+        # Include the sort keys for merging rows from more than one segment or sorting by day
+        needed = set(names) | ({'date', 'day_row'} if by_day else {'type_id', 'region_id', 'date'})
+        parts = []
+        for next_segment in self.segments:
+            if days is not None and not np.isin(next_segment.days, days).any():
+                continue
+            positions = next_segment.select(days, types, regions)
+            if len(positions) > 0:
+                parts.append({x: next_segment.columns[x][positions] for x in needed})
+        if len(parts) == 0:
+            values = {x: np.empty(0, dtype=dict(__store_columns__)[x]) for x in names}
+        elif len(parts) == 1 and not by_day:
+            values = parts[0]
+        else:
+            values = {x: np.concatenate([y[x] for y in parts]) for x in parts[0].keys()}
+            if by_day:
+                # Rows are unique by day and day_row, so a single key sort is enough
+                order = np.argsort(((values['date'] // __day_millis__) << 32) | values['day_row'])
+            else:
+                order = np.lexsort((values['date'], values['region_id'], values['type_id']))
+            values = {x: y[order] for x, y in values.items()}
+        result = DataFrame({x: values[x] for x in names}, columns=names)
+        if 'date' in names:
+            result['date'] = pd.to_datetime(result['date'].to_numpy(), unit='ms', utc=True).as_unit('us')
+        return result
+
+    def append(self, frame):
+        """
+        Add market history for days not yet in the store as a new segment.
+
+        :param frame: DataFrame of market history rows for one or more days in bulk file order, as returned
+                      by MarketHistory.get_day with the columnar setting
+        :return: number of rows added
+        """
+        if len(frame) == 0:
+            return 0
+        values = {x[0]: frame[x[0]].to_numpy() for x in __store_columns__ if x[0] not in ('date', 'day_row')}
+        values['date'] = pd.to_datetime(frame['date'], utc=True).array.as_unit('ms').asi8
+        days = frame_days(frame)
+        present = sorted(set(days.tolist()) & self.__day_set__)
+        if len(present) > 0:
+            raise Exception("Dates already in history store: %s" %
+                            ", ".join([str(datetime.date.fromordinal(x + __epoch_ordinal__)) for x in present]))
+        values['day_row'] = pd.Series(days).groupby(days).cumcount().to_numpy()
+        order = np.lexsort((values['day_row'], values['date'], values['region_id'], values['type_id']))
+        values = {x: y[order] for x, y in values.items()}
+        _HistorySegment.write(self.__next_segment__(), len(frame), [values], days)
+        self.refresh()
+        return len(frame)
+
+    def compact(self):
+        """
+        Merge all segments into one, so that each series is stored contiguously.  Rows are merged a range of types
+        at a time to bound memory use.
+        """
+        if len(self.segments) <= 1:
+            return
+        segments = self.segments
+        type_id = np.concatenate([x.series['type_id'] for x in segments])
+        count = np.concatenate([x.series['count'] for x in segments])
+        all_types, inverse = np.unique(type_id, return_inverse=True)
+        type_rows = np.bincount(inverse, weights=count, minlength=len(all_types)).astype(np.int64)
+        chunk_id = (np.cumsum(type_rows) - type_rows) // self.chunk_rows
+        bounds = np.flatnonzero(np.concatenate(([True], chunk_id[1:] != chunk_id[:-1], [True])))
+
+        def chunks():
+            for first, last in zip(bounds[:-1], bounds[1:]):
+                low, high = all_types[first], all_types[last - 1]
+                parts = []
+                for next_segment in segments:
+                    table = next_segment.series
+                    lo = np.searchsorted(table['type_id'], low, side='left')
+                    hi = np.searchsorted(table['type_id'], high, side='right')
+                    if hi > lo:
+                        start = int(table['start'][lo])
+                        end = int(table['start'][hi - 1] + table['count'][hi - 1])
+                        parts.append({x: y[start:end] for x, y in next_segment.columns.items()})
+                values = {x[0]: np.concatenate([y[x[0]] for y in parts]) for x in __store_columns__}
+                order = np.lexsort((values['date'], values['region_id'], values['type_id']))
+                yield {x: y[order] for x, y in values.items()}
+
+        # The merged segment supersedes the old ones as soon as it is in place, so the store stays consistent
+        # if the old segments can't be removed
+        _HistorySegment.write(self.__next_segment__(), self.row_count, chunks(),
+                              np.concatenate([x.days for x in segments]),
+                              sorted(set([x.number for x in segments] + [y for x in segments for y in x.superseded])))
+        for next_segment in segments:
+            next_segment.close()
+            HistoryStore.__remove__(next_segment.path)
+        self.segments = []
+        self.refresh()
+
+    @staticmethod
+    def __remove__(path):
+        # Another process may still have the segment open, which prevents removal on some platforms.  The
+        # segment is superseded, so removal is retried the next time a store is opened.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __next_segment__(self):
+        numbers = [x.number for x in self.segments]
+        return os.path.join(self.directory, "segment_%06d.hist" % (max(numbers, default=0) + 1))
+
+    def __str__(self):
+        return "HistoryStore[%s, %d segments, %d days, %d rows]" % (self.directory, len(self.segments),
+                                                                    len(self.__day_set__), self.row_count)
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,177 @@
+# evekit.marketdata.LiquidityScreen module
+"""
+Screen market history for liquid types.  Liquidity thresholds are tested for all (type, region) series at
+once with grouped counts and cumulative sums over arrays, rather than by filtering the history for each type.
+"""
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from .history_store import HistoryStore, day_number, frame_days, __day_millis__
+
+
+class LiquidityScreen:
+    """
+    A (type, region) series is liquid if it has market history for at least min_days days, and on every one
+    of those days:
+
+    - order_count is at least min_order_count
+    - volume is at least min_volume
+    - avg_price * volume is at least min_isk_volume
+    - avg_price is at most max_price
+
+    Thresholds which are None are not tested.  These are the filters used by liquid_types and
+    liquidity_filter in the examples.
+    """
+    chunk_cells = 4 * 1024 * 1024
+    """
+    Maximum number of (series, day) cells evaluated at a time by rolling.
+    """
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def __load__(history, dates, types, regions):
+        """
+        Extract the columns needed for screening.
+
+        :param history: DataFrame as returned by MarketHistory.get_data_frame, or a HistoryStore
+        :param dates: array-like of dates to screen, or None for all dates
+        :param types: array-like of types to screen, or None for all types
+        :param regions: array-like of regions to screen, or None for all regions
+        :return: map from column name to array for columns type_id, region_id, order_count, avg_price, volume
+                 and day (days since the epoch)
+        """
+        columns = ['type_id', 'region_id', 'order_count', 'avg_price', 'volume']
+        if isinstance(history, HistoryStore):
+            history = history.read(dates, types, regions, columns + ['date'])
+            keep = None
+        else:
+            keep = np.ones(len(history), dtype=bool)
+            if types is not None:
+                keep &= history['type_id'].isin(list(types)).to_numpy()
+            if regions is not None:
+                keep &= history['region_id'].isin(list(regions)).to_numpy()
+        values = {x: history[x].to_numpy() for x in columns}
+        values['day'] = frame_days(history) if len(history) > 0 else np.empty(0, dtype=np.int64)
+        if keep is not None and dates is not None:
+            keep &= np.isin(values['day'], np.array([day_number(x) for x in dates], dtype=np.int64))
+        if keep is not None and not keep.all():
+            values = {x: y[keep] for x, y in values.items()}
+        return values
+
+    @staticmethod
+    def __row_ok__(values, min_order_count, min_volume, min_isk_volume, max_price):
+        """
+        :return: boolean array, True for each row which meets all thresholds
+        """
+        ok = np.ones(len(values['volume']), dtype=bool)
+        if min_order_count is not None:
+            ok &= ~(values['order_count'] < min_order_count)
+        if min_volume is not None:
+            ok &= ~(values['volume'] < min_volume)
+        if min_isk_volume is not None:
+            ok &= ~(values['avg_price'] * values['volume'] < min_isk_volume)
+        if max_price is not None:
+            ok &= ~(values['avg_price'] > max_price)
+        return ok
+
+    @staticmethod
+    def __series__(values):
+        """
+        Number the (type, region) series of each row.
+
+        :return: tuple (series number of each row, type_id of each series, region_id of each series)
+        """
+        keys = (values['type_id'].astype(np.int64) << 32) | values['region_id'].astype(np.int64)
+        series, unique_keys = pd.factorize(keys)
+        return series, unique_keys >> 32, unique_keys & 0xffffffff
+
+    @staticmethod
+    def screen(history, min_days=0, min_order_count=None, min_volume=None, min_isk_volume=None, max_price=None,
+               dates=None, types=None, regions=None):
+        """
+        Find liquid types over all dates of a market history.
+
+        :param history: DataFrame as returned by MarketHistory.get_data_frame, or a HistoryStore
+        :param min_days: minimum number of days with market history
+        :param min_order_count: minimum daily order count, or None
+        :param min_volume: minimum daily volume, or None
+        :param min_isk_volume: minimum daily avg_price * volume, or None
+        :param max_price: maximum daily average price, or None
+        :param dates: array-like of dates to screen (e.g. weekends only), or None for all dates
+        :param types: array-like of types to screen, or None for all types
+        :param regions: array-like of regions to screen, or None for all regions
+        :return: map from region ID to the set of liquid type IDs in that region, with an entry for every region
+                 with market history
+        """
+        values = LiquidityScreen.__load__(history, dates, types, regions)
+        series, type_id, region_id = LiquidityScreen.__series__(values)
+        ok = LiquidityScreen.__row_ok__(values, min_order_count, min_volume, min_isk_volume, max_price)
+        days = np.bincount(series, minlength=len(type_id))
+        failed = np.bincount(series[~ok], minlength=len(type_id))
+        liquid = (days >= min_days) & (failed == 0)
+        result = {x: set() for x in np.unique(region_id).tolist()}
+        for next_region, next_type in zip(region_id[liquid].tolist(), type_id[liquid].tolist()):
+            result[next_region].add(next_type)
+        return result
+
+    @staticmethod
+    def rolling(history, window, min_days=0, min_order_count=None, min_volume=None, min_isk_volume=None,
+                max_price=None, dates=None, types=None, regions=None):
+        """
+        Find liquid types over a trailing window ending on each date of a market history.  This gives the types
+        which were liquid as of each date without looking ahead, e.g. for backtests.
+
+        :param history: DataFrame as returned by MarketHistory.get_data_frame, or a HistoryStore
+        :param window: window length in days, including the date the window ends on
+        :param min_days: minimum number of days with market history in the window.  A series always needs at
+                         least one day with market history in the window.
+        :param min_order_count: minimum daily order count, or None
+        :param min_volume: minimum daily volume, or None
+        :param min_isk_volume: minimum daily avg_price * volume, or None
+        :param max_price: maximum daily average price, or None
+        :param dates: array-like of dates to screen, or None for all dates
+        :param types: array-like of types to screen, or None for all types
+        :param regions: array-like of regions to screen, or None for all regions
+        :return: DataFrame indexed by date with columns date, type_id and region_id, with one row for each date
+                 with market history and each series which is liquid over the window ending on that date.  Rows
+                 are sorted by date, type and region.
+        """
+        values = LiquidityScreen.__load__(history, dates, types, regions)
+        series, type_id, region_id = LiquidityScreen.__series__(values)
+        ok = LiquidityScreen.__row_ok__(values, min_order_count, min_volume, min_isk_volume, max_price)
+        day = values['day']
+        found_series = []
+        found_day = []
+        if len(day) > 0:
+            first = int(day.min())
+            span = int(day.max()) - first + 1
+            # Windows end on each date with market history
+            ends = np.unique(day) - first
+            starts = np.maximum(ends - window + 1, 0)
+            chunk = max(1, LiquidityScreen.chunk_cells // span)
+            for low in range(0, len(type_id), chunk):
+                count = min(chunk, len(type_id) - low)
+                in_chunk = (series >= low) & (series < low + count)
+                # Count days with history and days failing a threshold for each (series, day) cell, then sum
+                # over each window with cumulative sums along the day axis
+                cell = (series[in_chunk] - low) * span + (day[in_chunk] - first)
+                sums = []
+                for next_cell in (cell, cell[~ok[in_chunk]]):
+                    cumulative = np.zeros((count, span + 1), dtype=np.int64)
+                    np.cumsum(np.bincount(next_cell, minlength=count * span).reshape(count, span), axis=1,
+                              out=cumulative[:, 1:])
+                    sums.append(cumulative[:, ends + 1] - cumulative[:, starts])
+                # A series needs at least one day of history in the window, otherwise a sparse series would be
+                # reported liquid on dates before its first row or long after its last one
+                liquid_series, liquid_end = np.nonzero((sums[0] >= max(min_days, 1)) & (sums[1] == 0))
+                found_series.append(liquid_series + low)
+                found_day.append(ends[liquid_end] + first)
+        found_series = np.concatenate(found_series) if len(found_series) > 0 else np.empty(0, dtype=np.int64)
+        found_day = np.concatenate(found_day) if len(found_day) > 0 else np.empty(0, dtype=np.int64)
+        order = np.lexsort((region_id[found_series], type_id[found_series], found_day))
+        date = pd.to_datetime(found_day[order] * __day_millis__, unit='ms', utc=True).as_unit('us')
+        return DataFrame({'date': date, 'type_id': type_id[found_series][order],
+                          'region_id': region_id[found_series][order]},
+                         columns=['date', 'type_id', 'region_id'], index=date.rename(None))
@@ -2,14 +2,25 @@
 """
 Retrieve and manipulate market history (daily market snapshots) in various ways
 """
+import io
 import os
 import gzip
 import urllib.error
-import urllib.request
+import numpy as np
+import pandas as pd
 from pandas import DataFrame
 from evekit.util import convert_raw_time
+from .bulk_index import BulkIndex
+from .day_loader import load_days
+from .archive_client import ArchiveClient
+from .archive_cache import ArchiveCache
+from .service_pool import ServicePool
+from .history_store import HistoryStore, day_number, frame_days
 from evekit.reference import Client
-from bravado.exception import HTTPError
+
+__history_columns__ = ['type_id', 'region_id', 'order_count', 'low_price', 'high_price', 'avg_price', 'volume', 'date']
+__history_dtypes__ = {'type_id': np.int64, 'region_id': np.int64, 'order_count': np.int64, 'low_price': np.float64,
+                      'high_price': np.float64, 'avg_price': np.float64, 'volume': np.int64, 'date': np.int64}
 
 
 class MarketHistory:
@@ -46,145 +57,226 @@ class MarketHistory:
                                             json['volume'], json['date'])
 
     @staticmethod
-    def __read_row__(types, regions, fobj):
+    def __read_row__(types, regions, fobj, compressed=True):
         """
         Extract market history rows for the given types and regions from the given file object
-        :param types: array-like of types to extract
-        :param regions: array-like of regions to extract
+        :param types: set of types to extract, or None for all types
+        :param regions: set of regions to extract, or None for all regions
         :param fobj: file object to read from
+        :param compressed: if True, fobj holds gzip data, otherwise plain rows
         :return: array of extracted MarketHistory objects
         """
         results = []
-        ps = gzip.GzipFile(fileobj=fobj)
+        ps = gzip.GzipFile(fileobj=fobj) if compressed else fobj
         for line in ps.readlines():
             line = line.decode('utf-8')
             next_obj = MarketHistory(line)
-            if next_obj.type_id in types and next_obj.region_id in regions:
+            if (types is None or next_obj.type_id in types) and (regions is None or next_obj.region_id in regions):
                 results.append(next_obj)
         ps.close()
         return results
 
     @staticmethod
-    def __read_bulk_file__(target_date, types, regions, parent_dir=".", is_tree=True):
+    def __read_frame__(types, regions, data):
+        """
+        Extract market history rows for the given types and regions from decompressed bulk data in columnar form.
+        :param types: array-like of types to extract, or None for all types
+        :param regions: array-like of regions to extract, or None for all regions
+        :param data: decompressed market history rows (bytes-like)
+        :return: DataFrame with the same columns as the fields of MarketHistory, in file order
+        """
+        if len(data) == 0:
+            return MarketHistory.__empty_frame__()
+        # round_trip float parsing gives the same values as float() in the MarketHistory constructor
+        frame = pd.read_csv(io.BytesIO(data), header=None, names=__history_columns__, dtype=__history_dtypes__,
+                            float_precision='round_trip')
+        keep = np.ones(len(frame), dtype=bool)
+        if types is not None:
+            keep &= frame['type_id'].isin(list(types)).to_numpy()
+        if regions is not None:
+            keep &= frame['region_id'].isin(list(regions)).to_numpy()
+        if not keep.all():
+            frame = frame[keep].reset_index(drop=True)
+        frame['date'] = pd.to_datetime(frame['date'].to_numpy(), unit='ms', utc=True).as_unit('us')
+        return frame
+
+    @staticmethod
+    def __empty_frame__():
+        frame = DataFrame({x: np.empty(0, dtype=y) for x, y in __history_dtypes__.items()}, columns=__history_columns__)
+        frame['date'] = pd.to_datetime(frame['date'].to_numpy(), unit='ms', utc=True).as_unit('us')
+        return frame
+
+    @staticmethod
+    def __parse_rows__(types, regions, chunks, columnar):
+        """
+        Extract market history rows from a list of decompressed chunks of bulk data.
+        :param types: array-like of types to extract, or None for all types
+        :param regions: array-like of regions to extract, or None for all regions
+        :param chunks: list of decompressed market history rows (bytes-like), in the order rows should be returned
+        :param columnar: if True return a DataFrame as described in __read_frame__, otherwise MarketHistory objects
+        :return: extracted rows
+        """
+        data = b''.join(chunks)
+        if columnar:
+            return MarketHistory.__read_frame__(types, regions, data)
+        return MarketHistory.__read_row__(None if types is None else set(types),
+                                          None if regions is None else set(regions), io.BytesIO(data), False)
+
+    @staticmethod
+    def __frame_from_objects__(values):
+        """
+        Convert MarketHistory objects to the DataFrame form described in __read_frame__.
+        :param values: array-like of MarketHistory objects
+        :return: DataFrame of the objects
+        """
+        if len(values) == 0:
+            return MarketHistory.__empty_frame__()
+        frame = DataFrame([x.__dict__ for x in values], columns=__history_columns__)
+        return frame.astype({x: y for x, y in __history_dtypes__.items() if x != 'date'})
+
+    @staticmethod
+    def __read_bulk_file__(target_date, types, regions, parent_dir=".", is_tree=True, index_sidecar=False,
+                           columnar=False):
         """
-        Extract the specified types and regions out of a bulk market history local file
+        Extract the specified types and regions out of a bulk market history local file.  If the index file
+        for the bulk file is present, only the blocks for the requested types are read and decompressed.
         :param target_date: date to extract
-        :param types: array-like of types to extract
-        :param regions: array-like of regions to extract
+        :param types: array-like of types to extract, or None for all types
+        :param regions: array-like of regions to extract, or None for all regions
         :param parent_dir: parent directory where local files are stored
         :param is_tree: if true, market history is organized as a tree
-        :return: array of extracted MarketHistory objects
+        :param index_sidecar: if True, keep a binary copy of the index next to the index file
+        :param columnar: if True, return a DataFrame (see __read_frame__) instead of MarketHistory objects
+        :return: array of extracted MarketHistory objects in bulk file order, or a DataFrame if columnar
         """
         path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
         date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
         bulk_file = parent_dir + "/" + (path_string if is_tree else "") + "/market_" + date_string + ".bulk"
+        index_file = parent_dir + "/" + (path_string if is_tree else "") + "/market_" + date_string + ".index.gz"
         if not os.path.exists(bulk_file):
-            return []
-        return MarketHistory.__read_row__(types, regions, open(bulk_file, 'rb'))
+            return MarketHistory.__parse_rows__(types, regions, [], columnar)
+        if types is None or not os.path.exists(index_file):
+            # All types wanted or no index, so scan the whole file
+            with open(bulk_file, 'rb') as fobj:
+                return MarketHistory.__parse_rows__(types, regions, [gzip.decompress(fobj.read())], columnar)
+        max_offset = os.stat(bulk_file).st_size
+        if max_offset == 0:
+            return MarketHistory.__parse_rows__(types, regions, [], columnar)
+        index_map = BulkIndex.load(index_file, max_offset, index_sidecar)
+        found, start, end = index_map.locate(list(dict.fromkeys(types)))
+        chunks = []
+        with open(bulk_file, 'rb') as fobj:
+            # Read blocks in file order so rows are returned in the same order as a full scan
+            for block_start, block_end in sorted(zip(start[found].tolist(), end[found].tolist())):
+                fobj.seek(block_start)
+                chunks.append(gzip.decompress(fobj.read(block_end - block_start + 1)))
+        return MarketHistory.__parse_rows__(types, regions, chunks, columnar)
 
     @staticmethod
     def __read_index__(fobj, max_offset):
         """
-        Read market history index file and return a map from type to offsets
+        Read market history index file and return a map from type to offsets.
         :param fobj: file object to read from
         :param max_offset: max offset to report for last value
-        :return: map from type to array of offsets
+        :return: BulkIndex mapping type to (start, end) offsets
         """
-        result = {}
-        last_type = -1
-        for line in gzip.GzipFile(fileobj=fobj).readlines():
-            line = line.decode('utf-8')
-            fields = line.split(" ")
-            type_id = int((fields[0].split("_"))[1])
-            offset = int(fields[1])
-            result[type_id] = [offset, -1]
-            if last_type != -1:
-                result[last_type][1] = offset - 1
-            last_type = type_id
-        if last_type != -1:
-            result[last_type][1] = max_offset
-        return result
+        return BulkIndex.parse(fobj, max_offset)
 
     @staticmethod
-    def __read_archive__(target_date, types, regions):
+    def __read_archive__(target_date, types, regions, archive_url=None, max_concurrency=1, cache=None,
+                         columnar=False):
         """
         Read market history from archive.
         :param target_date: target date to retrieve
-        :param types: array-like of types to retrieve
-        :param regions: array-like of regions to retrieve
-        :return: array of retrieved MarketHistory objects
+        :param types: array-like of types to retrieve, or None for all types
+        :param regions: array-like of regions to retrieve, or None for all regions
+        :param archive_url: base URL of the archive, or None for the default archive
+        :param max_concurrency: maximum number of concurrent requests
+        :param cache: optional ArchiveCache to read through
+        :param columnar: if True, return a DataFrame (see __read_frame__) instead of MarketHistory objects
+        :return: array of retrieved MarketHistory objects, or a DataFrame if columnar
         """
+        client = ArchiveClient.get_client(archive_url)
         date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
         path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
-        bulk_file = "market_" + date_string + ".bulk"
-        index_file = "market_" + date_string + ".index.gz"
-        bulk_url = "https://storage.googleapis.com/evekit_md/" + path_string + "/" + bulk_file
-        index_url = "https://storage.googleapis.com/evekit_md/" + path_string + "/" + index_file
+        bulk_file = path_string + "/market_" + date_string + ".bulk"
+        index_file = path_string + "/market_" + date_string + ".index.gz"
         max_offset = -1
         # Minor tuning optimization.  If less than this many types are requested then we use the
-        # index file and make a separate call for each type.  Otherwise, we just read the entire
-        # bulk file.
+        # index file and fetch just the blocks for those types.  Otherwise, we just read the entire
+        # bulk file, unless requests may be made concurrently in which case fetching blocks is faster.
         type_count_threshold = 5
-        results = []
         try:
-            if len(types) < type_count_threshold:
-                # Use the index map and make multiple requests
-                index_map = MarketHistory.__read_index__(urllib.request.urlopen(index_url), max_offset)
-                for next_type in types:
-                    if next_type not in index_map:
-                        continue
-                    range_string = "bytes=" + str(index_map[next_type][0]) + "-"
-                    if index_map[next_type][1] != -1:
-                        range_string += str(index_map[next_type][1])
-                    request = urllib.request.Request(bulk_url, headers={"Range": range_string})
-                    results.extend(MarketHistory.__read_row__([next_type], regions, urllib.request.urlopen(request)))
+            if types is not None and (len(types) < type_count_threshold or max_concurrency > 1):
+                # Use the index map and fetch the blocks for the requested types
+                index_map = MarketHistory.__read_index__(io.BytesIO(client.fetch(index_file, cache)), max_offset)
+                found = [x for x in dict.fromkeys(types) if x in index_map]
+                blocks = {}
+                for pos, block in client.iter_ranges(bulk_file, [index_map[x] for x in found],
+                                                     max_concurrency=max_concurrency, decode=gzip.decompress,
+                                                     cache=cache):
+                    blocks[found[pos]] = block
+                chunks = [blocks[x] for x in types if x in blocks]
             else:
                 # Read the entire bulk file in one shot
-                results.extend(MarketHistory.__read_row__(types, regions, urllib.request.urlopen(bulk_url)))
+                chunks = [gzip.decompress(client.fetch(bulk_file, cache))]
         except urllib.error.HTTPError:
-            return []
-        return results
+            chunks = []
+        return MarketHistory.__parse_rows__(types, regions, chunks, columnar)
 
     @staticmethod
-    def __read_service__(target_date, types, regions):
+    def __read_service__(target_date, types, regions, pool=None, service_url=None):
         """
         Read market history from Orbital Enterprises market data service.  A separate call is made
         for each type and region.  This is very inefficient for large sets of types or regions.
-        Use carefully.
+        Use carefully, preferably with a ServicePool which makes calls concurrently.
         :param target_date: date for which history will be retrieved
-        :param types: array-like of types to retrieve
+        :param types: array-like of types to retrieve.  The service can not retrieve all types, so if either
+                      types or regions is None then nothing is retrieved.
         :param regions: array-like of regions to retrieve
+        :param pool: ServicePool used to make calls, or None to make calls one at a time
+        :param service_url: URL of the market data service swagger spec, or None for the default service
         :return: array of MarketHistory results
         """
-        client = Client.MarketData.get()
-        results = []
-        for next_type in types:
-            for next_region in regions:
-                try:
-                    result, response = client.MarketData.history(typeID=next_type, regionID=next_region,
-                                                                 date=str(target_date)).result()
-                    if response.status_code != 200:
-                        continue
-                    results.append(MarketHistory(MarketHistory.__json_to_string__(result)))
-                except HTTPError:
-                    continue
-        return results
+        if types is None or regions is None:
+            return []
+        client = Client.MarketData.get(service_url)
+        pool = ServicePool() if pool is None else pool
+        calls = [dict(typeID=next_type, regionID=next_region, date=str(target_date))
+                 for next_type in types for next_region in regions]
+        return [MarketHistory(MarketHistory.__json_to_string__(x)) for x in pool.map(client.MarketData.history, calls)
+                if x is not None]
 
     @staticmethod
     def get_day(date, types, regions, config=None):
         """
         Retrieve a single day of market history for the given types and regions.
         :param date: date to retrieve
-        :param types: array-like of types for which history will be retrieved.
-        :param regions: array-like of regions for which history will be retrieved.
+        :param types: array-like of types for which history will be retrieved, or None for all types.
+        :param regions: array-like of regions for which history will be retrieved, or None for all regions.
+                        The market data service is not used when either types or regions is None.
         :param config: optional config parameter with settings:
           verbose - if True, show what we're doing when we do it
           as_dict - if True, convert MarketHistory objects to dictionaries before returning
+          columnar - if True, return a DataFrame with one column per MarketHistory field instead of objects.
+                     Rows are parsed with a vectorized CSV reader, which is much faster for large type sets.
           skip_missing - if True, skip missing data, otherwise throw an exception
           local_storage - if present, gives the parent directory for local storage containing market history
           tree - if True, then local st
           orage is organized as a date tree
+          index_sidecar - if True, keep a binary copy of each local bulk index next to the index file
           use_online - if True, use either the online archive or market data service to fill missing dates.
+          archive_url - base URL of the online archive (default archive_client.ARCHIVE_URL)
+          archive_concurrency - number of concurrent requests to the online archive (default 1)
+          archive_cache - if present, directory of a disk cache for data downloaded from the online archive
+          archive_cache_size - maximum size in bytes of the archive cache (default ArchiveCache.default_size).
+                               Least recently used data is evicted first.
+          service_workers - number of concurrent calls to the market data service (default 1)
+          service_rate - if present, maximum number of market data service calls started per second
+          service_timeout - if present, timeout in seconds for each market data service call
+          service_pool - if present, a ServicePool to use for market data service calls instead of creating one
+                         from the settings above.  Use this to share a rate limit or collect call statistics.
+          service_url - URL of the market data service swagger spec (default is the Orbital Enterprises service)
         :return: an array of market history for the given day for each of the specified types and regions.
         """
         results = []
@@ -195,32 +287,57 @@ class MarketHistory:
         verbose = config.get('verbose', False)
         skip_missing = config.get('skip_missing', True)
         as_dict = config.get('as_dict', False)
+        columnar = config.get('columnar', False)
         # Try local storage first if present, then online sources if configured
         if use_local:
             if verbose:
                 print("checking local source...", end="")
             is_tree = config.get('tree', False)
-            values = MarketHistory.__read_bulk_file__(date, types, regions, local_storage_dir, is_tree)
-            if as_dict:
-                values = [x.__dict__ for x in values]
-            results.extend(values)
+            values = MarketHistory.__read_bulk_file__(date, types, regions, local_storage_dir, is_tree,
+                                                      config.get('index_sidecar', False), columnar)
+            if columnar:
+                results = values
+            else:
+                if as_dict:
+                    values = [x.__dict__ for x in values]
+                results.extend(values)
         # Try online if no local storage, or local storage doesn't have data
         if len(results) == 0 and use_online:
             if verbose:
                 print("checking online sources...", end="")
             # Try archive first
-            values = MarketHistory.__read_archive__(date, types, regions)
+            values = MarketHistory.__read_archive__(date, types, regions, config.get('archive_url', None),
+                                                    config.get('archive_concurrency', 1),
+                                                    ArchiveCache.from_config(config), columnar)
             if len(values) == 0:
                 # Last chance, try the market service
-                values = MarketHistory.__read_service__(date, types, regions)
-            if as_dict:
-                values = [x.__dict__ for x in values]
-            results.extend(values)
+                values = MarketHistory.__read_service__(date, types, regions, ServicePool.from_config(config),
+                                                        config.get('service_url', None))
+                if columnar:
+                    values = MarketHistory.__frame_from_objects__(values)
+            if columnar:
+                results = values
+            else:
+                if as_dict:
+                    values = [x.__dict__ for x in values]
+                results.extend(values)
         # If still no data, then check whether we should complain
         if len(results) == 0 and not skip_missing:
             raise Exception("No data found for date %s" % date)
+        if columnar and len(results) == 0:
+            results = MarketHistory.__empty_frame__()
         return results
 
+    @staticmethod
+    def __frame_nbytes__(frame):
+        """
+        Estimate the memory used by a market history DataFrame.
+
+        :param frame: DataFrame returned by get_day with the columnar setting
+        :return: approximate size in bytes
+        """
+        return int(frame.memory_usage(index=True).sum())
+
     @staticmethod
     def get_data_frame(dates, types, regions, config=None):
         """
@@ -233,19 +350,126 @@ class MarketHistory:
           skip_missing - if True, skip dates for which data can not be found
           local_storage - if present, gives the parent directory for local storage containing market history
           tree - if True, then local storage is organized as a date tree
+          index_sidecar - if True, keep a binary copy of each local bulk index next to the index file
           use_online - if True, use either the online archive or market data service to fill missing dates.
+          archive_url - base URL of the online archive (default archive_client.ARCHIVE_URL)
+          archive_concurrency - number of concurrent requests to the online archive (default 1)
+          archive_cache - if present, directory of a disk cache for data downloaded from the online archive
+          archive_cache_size - maximum size in bytes of the archive cache (default ArchiveCache.default_size).
+                               Least recently used data is evicted first.
+          service_workers - number of concurrent calls to the market data service (default 1)
+          service_rate - if present, maximum number of market data service calls started per second
+          service_timeout - if present, timeout in seconds for each market data service call
+          service_pool - if present, a ServicePool to use for market data service calls instead of creating one
+                         from the settings above.  Use this to share a rate limit or collect call statistics.
+          service_url - URL of the market data service swagger spec (default is the Orbital Enterprises service)
+          max_inflight_days - number of days to load concurrently (default 1).  Results are identical to loading
+                              days one at a time.
+          max_memory - if present, approximate bound in bytes on memory used by days being loaded concurrently.
+          day_pool - 'process' (default) or 'thread', the type of pool used to load days concurrently.  A thread
+                     pool is used if service_pool is given, as it can't be shared with other processes.
+          history_store - directory of a HistoryStore created by update_store, a HistoryStore, or False to
+                          ignore any store.  Defaults to market_history.store in local storage.  Dates in the
+                          store are read from it instead of from daily bulk files, with identical results.
         :return: DataFrame contained the requested data indexed by market history date.
         """
         config = {} if config is None else config
-        config['as_dict'] = True
         verbose = config.get('verbose', False)
-        # Turn off verbose in called methods
-        config['verbose'] = False
-        results = []
-        for next_date in dates:
+        store = HistoryStore.from_config(config)
+        in_store = [False] * len(dates) if store is None else [x in store for x in dates]
+        to_load = [x for x, y in zip(dates, in_store) if not y]
+        # Days are loaded in columnar form.  Turn off verbose in called methods.  The store is only read here,
+        # so it is not passed on to days loaded in another process.
+        day_config = dict(config, columnar=True, verbose=False, history_store=False)
+        frames = []
+        for next_date, values in load_days(to_load, MarketHistory.get_day, (types, regions, day_config),
+                                           config.get('max_inflight_days', 1), config.get('max_memory', None),
+                                           MarketHistory.__frame_nbytes__, config.get('day_pool', 'process')):
+            if verbose:
+                print("Retrieving %s...done" % (str(next_date)))
+            frames.append(values)
+        if len(to_load) < len(dates):
+            if verbose:
+                print("Retrieving %d dates from %s...done" % (len(dates) - len(to_load), store.directory))
+            stored = store.read([x for x, y in zip(dates, in_store) if y], types, regions, by_day=True)
+            frames = MarketHistory.__date_order__(dates, in_store, stored, frames)
+        frames = [x for x in frames if len(x) > 0]
+        if len(frames) == 0:
+            return DataFrame([], [])
+        result = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        result.index = pd.DatetimeIndex(result['date']).rename(None)
+        return result
+
+    @staticmethod
+    def __date_order__(dates, in_store, stored, frames):
+        """
+        Merge rows read from a history store with days loaded from bulk files, in the order get_data_frame would
+        return them if all days were loaded: by position of the date in dates, then in bulk file order.
+        :param dates: array-like of requested dates
+        :param in_store: list of flags, True for each date read from the store
+        :param stored: DataFrame read from a HistoryStore with the by_day setting
+        :param frames: list of DataFrames for dates not read from the store, in the same order as those dates
+        :return: list of DataFrames, one for each date
+        """
+        days = frame_days(stored)
+        loaded = iter(frames)
+        result = []
+        last_end = 0
+        for next_date, from_store in zip(dates, in_store):
+            if from_store:
+                next_day = day_number(next_date)
+                start, end = np.searchsorted(days, [next_day, next_day + 1])
+                # Extend the previous slice of the store where possible, which saves copying when dates are sorted
+                if len(result) > 0 and result[-1] is not None and start == last_end:
+                    result[-1] = (result[-1][0], end)
+                else:
+                    result.append((start, end))
+                last_end = end
+            else:
+                result.append(None)
+        return [next(loaded) if x is None else stored.iloc[x[0]:x[1]] for x in result]
+
+    @staticmethod
+    def update_store(dates, config=None):
+        """
+        Add dates to the consolidated history store used by get_data_frame, creating the store if needed.  All
+        types and regions are loaded for each date not already in the store, using get_day with the same
+        sources and settings.  Dates with no data are skipped.  The store is compacted when it has more than
+        HistoryStore.max_segments segments.
+        :param dates: array-like of dates to add
+        :param config: optional config parameter with the settings described in get_day, plus:
+          history_store - directory of the store, or a HistoryStore.  Defaults to market_history.store in
+                          local storage.
+          store_batch_days - number of dates loaded into memory and added to the store at a time (default 30)
+        :return: number of dates added
+        """
+        config = {} if config is None else config
+        verbose = config.get('verbose', False)
+        path = HistoryStore.store_path(config)
+        if path is None:
+            raise Exception("No history store configured")
+        store = HistoryStore.from_config(config) if os.path.isdir(path) else HistoryStore(path)
+        day_config = dict(config, columnar=True, verbose=False, skip_missing=True)
+        batch_days = config.get('store_batch_days', 30)
+        to_add = [x for x in dates if x not in store]
+        added = 0
+        for first in range(0, len(to_add), batch_days):
+            frames = []
+            for next_date in to_add[first:first + batch_days]:
+                if verbose:
+                    print("Retrieving %s..." % str(next_date), end="")
+                values = MarketHistory.get_day(next_date, None, None, day_config)
+                if len(values) > 0:
+                    frames.append(values)
+                    added += 1
+                if verbose:
+                    print("done")
+            if len(frames) > 0:
+                store.append(pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0])
+        if len(store.segments) > store.max_segments:
             if verbose:
-                print("Retrieving %s" % (str(next_date)), end="...")
-            results.extend(MarketHistory.get_day(next_date, types, regions, config))
+                print("Compacting %s..." % store.directory, end="")
+            store.compact()
             if verbose:
                 print("done")
-        return DataFrame(results, [x['date'] for x in results])
+        return added
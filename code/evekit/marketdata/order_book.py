@@ -2,16 +2,33 @@
 """
 Retrieve and manipulate order books in various ways
 """
+import io
 import os
 import gzip
 import urllib.error
 import urllib.request
 import datetime
-import io
+import calendar
+import bisect
+import mmap
+import concurrent.futures
+import contextlib
+import numpy as np
+import pandas as pd
 from pandas import DataFrame
 from evekit.util import convert_raw_time
+from .columnar_book import ColumnarOrderBook, SnapshotColumns, ORDER_DTYPE, encode_order_range, \
+    decode_order_ranges, parse_book_block, decompress_block, parse_bulk_range, parse_region_slices, \
+    block_region_offsets, top_of_book_columns, iter_block_snapshots, split_block_regions
+from .book_store import BookStore
+from .price_ladder import PriceLadder
+from .day_loader import load_days
+from .bulk_index import BulkIndex, RegionIndex
+from .archive_client import ArchiveClient
+from .archive_cache import ArchiveCache
+from .book_cache import BookCache
+from .service_pool import ServicePool
 from evekit.reference import Client
-from bravado.exception import HTTPError
 
 
 class MarketOrder:
@@ -66,50 +83,137 @@ class MarketOrder:
                                                          json_result['locationID'], json_result['duration'])
         return MarketOrder(init_string)
 
+    def __to_row__(self):
+        raw_issued = calendar.timegm(self.issued.utctimetuple()) * 1000 + self.issued.microsecond // 1000
+        return (self.order_id, self.buy, raw_issued, self.price, self.volume_entered, self.min_volume,
+                self.volume, encode_order_range(self.order_range), self.location_id, self.duration)
+
+
+__snapshot_index_fields__ = ('__id_state__', '__id_set__', '__bid_key_state__', '__ask_key_state__')
+
+__market_order_fields__ = ('order_id', 'buy', 'issued', 'price', 'volume_entered', 'min_volume', 'volume',
+                           'order_range', 'location_id', 'duration')
+
 
 class MarketSnapshot:
     """
-    Order book snapshot
+    Order book snapshot.  Bids are ordered by price descending and asks by price ascending.  The set of
+    order IDs and the price keys of each side are built on first use and maintained by the add and insert
+    methods, so membership tests are O(1) and insert positions are found by bisection.  If bid or ask is
+    replaced, or changes length, outside of these methods the indexes are rebuilt on next use.
     """
+    __id_state__ = None
+    __id_set__ = None
+    __bid_key_state__ = None
+    __ask_key_state__ = None
+
     def __init__(self, snapshot_time):
         self.snapshot_time = snapshot_time
         self.bid = []
         self.ask = []
 
+    def __getstate__(self):
+        # Indexes are rebuilt on demand and are not worth pickling
+        return {k: v for k, v in self.__dict__.items() if k not in __snapshot_index_fields__}
+
+    def __ids_valid__(self):
+        state = self.__id_state__
+        return state is not None and state[0] is self.bid and state[1] == len(self.bid) and \
+            state[2] is self.ask and state[3] == len(self.ask)
+
+    def order_ids(self):
+        """
+        :return: set of order IDs in this snapshot.  This set is maintained by the snapshot, do not modify it.
+        """
+        if not self.__ids_valid__():
+            self.__id_set__ = set([x.order_id for x in self.bid]).union([x.order_id for x in self.ask])
+            self.__id_state__ = (self.bid, len(self.bid), self.ask, len(self.ask))
+        return self.__id_set__
+
     def contains(self, order):
-        return order.order_id in [x.order_id for x in self.bid + self.ask]
-    
+        return order.order_id in self.order_ids()
+
+    def __side_keys__(self, buy):
+        # Bids are keyed by negative price so that both sides are searched in ascending order.
+        # None marks a side which is not sorted by price.
+        side = self.bid if buy else self.ask
+        state = self.__bid_key_state__ if buy else self.__ask_key_state__
+        if state is None or state[0] is not side or state[1] != len(side):
+            keys = [-x.price for x in side] if buy else [x.price for x in side]
+            if any([keys[j] > keys[j + 1] for j in range(len(keys) - 1)]):
+                keys = None
+            state = (side, len(side), keys)
+            if buy:
+                self.__bid_key_state__ = state
+            else:
+                self.__ask_key_state__ = state
+        return state[2]
+
+    def __place__(self, order, buy, position=None):
+        # Add order to a side at the given position, or at the end if position is None, and keep indexes current
+        ids_valid = self.__ids_valid__()
+        side = self.bid if buy else self.ask
+        state = self.__bid_key_state__ if buy else self.__ask_key_state__
+        keys_valid = state is not None and state[0] is side and state[1] == len(side)
+        if position is None:
+            position = len(side)
+        side.insert(position, order)
+        if keys_valid:
+            keys = state[2]
+            if keys is not None:
+                key = -order.price if buy else order.price
+                keys.insert(position, key)
+                if (position > 0 and keys[position - 1] > key) or \
+                        (position + 1 < len(keys) and key > keys[position + 1]):
+                    keys = None
+            state = (side, len(side), keys)
+            if buy:
+                self.__bid_key_state__ = state
+            else:
+                self.__ask_key_state__ = state
+        if ids_valid:
+            self.__id_set__.add(order.order_id)
+            self.__id_state__ = (self.bid, len(self.bid), self.ask, len(self.ask))
+
     def add_bid(self, bid):
-        self.bid.append(bid)
+        self.__place__(bid, True)
 
     def add_ask(self, ask):
-        self.ask.append(ask)
+        self.__place__(ask, False)
+
+    def __insert__(self, order, buy):
+        # New orders are placed after resting orders at the same price
+        keys = self.__side_keys__(buy)
+        if keys is not None:
+            self.__place__(order, buy, bisect.bisect_right(keys, -order.price if buy else order.price))
+            return
+        # Side is not sorted, place before the first order with a worse price
+        side = self.bid if buy else self.ask
+        for i in range(len(side)):
+            if (side[i].price < order.price) if buy else (side[i].price > order.price):
+                self.__place__(order, buy, i)
+                return
+        self.__place__(order, buy)
 
     def insert_bid(self, bid):
-        # Bids ordered by price descending
-        if len(self.bid) == 0:
-            self.add_bid(bid)
-        else:
-            for i in range(len(self.bid)):
-                if self.bid[i].price < bid.price:
-                    break
-            self.bid[i:i] = [bid]
+        self.__insert__(bid, True)
 
     def insert_ask(self, ask):
-        # Asks ordered by price ascending
-        if len(self.ask) == 0:
-            self.add_ask(ask)
-        else:
-            for i in range(len(self.ask)):
-                if self.ask[i].price > ask.price:
-                    break
-            self.ask[i:i] = [ask]
+        self.__insert__(ask, False)
 
     def insert_order(self, order):
-        if order.buy:
-            self.insert_bid(order)
-        else:
-            self.insert_ask(order)
+        self.__insert__(order, order.buy)
+
+    def ladder(self, buy, location=None):
+        """
+        Create a price ladder for one side of this snapshot.
+
+        :param buy: True for the bid side, False for the ask side
+        :param location: optional location ID to restrict orders to
+        :return: PriceLadder for the side
+        """
+        orders = [x for x in (self.bid if buy else self.ask) if location is None or x.location_id == location]
+        return PriceLadder([x.price for x in orders], [x.volume for x in orders], [x.min_volume for x in orders], buy)
 
     def __str__(self):
         result = "MarketSnapshot[time=%s, bidCount=%d, askCount=%d,\n" % (
@@ -139,15 +243,15 @@ class MarketSnapshot:
         return new_snap
 
 
-def __dline__(ps):
-    next_line = ps.readline().strip()
-    return next_line.decode('utf-8')
-
-
 class OrderBook:
     """
     OrderBook snapshots for a given type on a given date, optionally filtered to a specific set of regions.
     """
+    __stream_chunk_size__ = 1 << 16
+    """
+    Size of compressed chunks read by snapshot streams.
+    """
+
     def __init__(self, dt, size=5, ps=None, region_id=None):
         """
         Initialize order book from stream (if present).
@@ -162,38 +266,67 @@ class OrderBook:
         self.interval_size = size
         if ps is None:
             return
-        self.type_id = int(__dline__(ps))
-        snapshot_count = int(__dline__(ps))
-        # Read regions until EOF
+        self.__load_block__(ps.read(), region_id)
+
+    def __load_block__(self, data, region_id=None):
+        self.type_id, region_columns = parse_book_block(data, region_id)
         self.region = {}
-        next_region = __dline__(ps)
-        while len(next_region) > 0:
-            next_region = int(next_region)
-            snaps = []
-            for i in range(snapshot_count):
-                raw_time = int(__dline__(ps))
-                snapshot_time = convert_raw_time(raw_time)
-                bid_count = int(__dline__(ps))
-                ask_count = int(__dline__(ps))
-                next_snap = MarketSnapshot(snapshot_time)
-                for j in range(bid_count):
-                    next_line = __dline__(ps)
-                    if region_id is None or next_region in region_id:
-                        next_snap.add_bid(MarketOrder(next_line))
-                for j in range(ask_count):
-                    next_line = __dline__(ps)
-                    if region_id is None or next_region in region_id:
-                        next_snap.add_ask(MarketOrder(next_line))
-                if region_id is None or next_region in region_id:
-                    snaps.append(next_snap)
-            # Store new region
-            if region_id is None or next_region in region_id:
-                self.region[next_region] = snaps
-            if region_id is not None and len(self.region.keys()) == len(region_id):
-                # Short circuit, we have all the regions we want
-                break
-            # Iterate to next region
-            next_region = __dline__(ps)
+        for next_region in region_columns.keys():
+            self.region[next_region] = OrderBook.__snapshots_from_columns__(region_columns[next_region])
+
+    @staticmethod
+    def from_block(dt, data, size=5, region_id=None):
+        """
+        Create an order book from a decompressed type block of an interval bulk file.
+
+        :param dt: datetime for day represented by order book
+        :param data: decompressed type block (bytes-like)
+        :param size: interval size in minutes
+        :param region_id: optional set of region IDs to include.  If None, then include all regions contained
+                          in the block.
+        :return: a new OrderBook
+        """
+        book = OrderBook(dt, size)
+        book.__load_block__(data, region_id)
+        return book
+
+    @staticmethod
+    def __snapshots_from_columns__(columns):
+        """
+        Materialize MarketSnapshot and MarketOrder objects from columnar snapshots.  Orders are
+        created directly from column values, and issue times are converted once per distinct value.
+
+        :param columns: SnapshotColumns to convert
+        :return: list of MarketSnapshot
+        """
+        orders = columns.orders
+        issued_map = {}
+        issued_list = []
+        for raw_time in orders['issued'].tolist():
+            issued = issued_map.get(raw_time)
+            if issued is None:
+                issued = issued_map[raw_time] = convert_raw_time(raw_time)
+            issued_list.append(issued)
+        order_list = []
+        new_order = MarketOrder.__new__
+        for values in zip(orders['order_id'].tolist(), orders['buy'].tolist(), issued_list,
+                          orders['price'].tolist(), orders['volume_entered'].tolist(),
+                          orders['min_volume'].tolist(), orders['volume'].tolist(),
+                          decode_order_ranges(orders['order_range']).tolist(),
+                          orders['location_id'].tolist(), orders['duration'].tolist()):
+            next_order = new_order(MarketOrder)
+            next_order.__dict__.update(zip(__market_order_fields__, values))
+            order_list.append(next_order)
+        snaps = []
+        offsets = columns.offsets.tolist()
+        bid_count = columns.bid_count.tolist()
+        for i, raw_time in enumerate(columns.snapshot_time.tolist()):
+            next_snap = MarketSnapshot(convert_raw_time(raw_time))
+            middle = offsets[i] + bid_count[i]
+            next_snap.bid = order_list[offsets[i]:middle]
+            next_snap.ask = order_list[middle:offsets[i + 1]]
+            snaps.append(next_snap)
+        return snaps
 
     def __str__(self):
         result = "OrderBook[date=%s, intervalSize=%d, typeID=%d,\n" % (self.date, self.interval_size, self.type_id)
@@ -206,70 +339,98 @@ class OrderBook:
     def __repr__(self):
         return str(self)
 
+    def to_columnar(self):
+        """
+        Convert this order book to columnar form.
+
+        :return: a ColumnarOrderBook containing the same snapshots as this book
+        """
+        result = ColumnarOrderBook(self.date, self.interval_size)
+        result.type_id = self.type_id
+        for region_id in self.region.keys():
+            snaps = self.region[region_id]
+            rows = [x.__to_row__() for snap in snaps for x in snap.bid + snap.ask]
+            snapshot_time = [calendar.timegm(x.snapshot_time.utctimetuple()) * 1000 +
+                             x.snapshot_time.microsecond // 1000 for x in snaps]
+            result.region[region_id] = SnapshotColumns.from_counts(snapshot_time,
+                                                                   [len(x.bid) for x in snaps],
+                                                                   [len(x.ask) for x in snaps],
+                                                                   np.array(rows, dtype=ORDER_DTYPE))
+        return result
+
+    @staticmethod
+    def from_columnar(book):
+        """
+        Convert a columnar order book to an OrderBook of MarketSnapshot and MarketOrder objects.
+
+        :param book: ColumnarOrderBook to convert
+        :return: an equivalent OrderBook
+        """
+        result = OrderBook(book.date, book.interval_size)
+        result.type_id = book.type_id
+        result.region = {}
+        for region_id in book.region.keys():
+            result.region[region_id] = OrderBook.__snapshots_from_columns__(book.region[region_id])
+        return result
+
     """
-    Copy an order into previous snapshots starting from index and working
-    backwards until we find a snapshot that either already contains the order,
-    or has a timestamp before the issue date of the new order.
-    """
-    def __backfill_order__(self, order, region_id, index):
-        issued = order.issued
-        snaps = self.region[region_id]
-        for i in range(index, -1, -1):
-            next_snap = snaps[i]
-            if next_snap.snapshot_time < issued or next_snap.contains(order):
-                return
-            order_copy = order.copy()
-            next_snap.insert_order(order_copy)
-    
-    """
-    Look for order gapping and backfill to fix.
+    Look for order gapping and backfill to fix.  When an order appears in a snapshot but is missing
+    from the previous snapshot even though it was issued before that snapshot, the order is copied
+    into previous snapshots starting from the previous snapshot and working backwards until we find
+    a snapshot that either already contains the order, or has a timestamp before the issue date
+    of the order.
+
+    Order ID sets and price keys for each snapshot are built once and maintained as orders are
+    inserted, so the total cost is close to linear in the number of orders.
     """
     def fill_gaps(self):
         for region_id in self.region.keys():
+            snaps = self.region[region_id]
             # Cycle through snapshots in pairs, look for orders we need to backfill
-            snap_list = self.region[region_id]
-            for i in range(0, len(snap_list) - 1):
-                current_snap = snap_list[i]
-                current_time = current_snap.snapshot_time
-                next_snap = snap_list[i+1]
-                next_time = next_snap.snapshot_time
-                #
+            for i in range(0, len(snaps) - 1):
+                current_time = snaps[i].snapshot_time
+                next_snap = snaps[i + 1]
+                current_ids = snaps[i].order_ids()
                 # Look for new orders added in the next snapshot
-                #
-                all_current_orders = current_snap.bid + current_snap.ask
-                all_new_orders = next_snap.bid + next_snap.ask
-                new_id_set = set([x.order_id for x in all_new_orders]).difference(set([x.order_id for x in all_current_orders]))
-                if len(new_id_set) > 0:
-                    for next_order in all_new_orders:
-                        if next_order.order_id in new_id_set and next_order.issued < current_time:
-                            # Gap - backfill
-                            self.__backfill_order__(next_order, region_id, i)
-    
+                new_orders = [x for x in next_snap.bid + next_snap.ask
+                              if x.order_id not in current_ids and x.issued < current_time]
+                for next_order in new_orders:
+                    # Gap - backfill
+                    OrderBook.__backfill_order__(snaps, next_order, i)
+
+    @staticmethod
+    def __backfill_order__(snaps, order, index):
+        issued = order.issued
+        for i in range(index, -1, -1):
+            if snaps[i].snapshot_time < issued or snaps[i].contains(order):
+                return
+            snaps[i].insert_order(order.copy())
+
+    def diffs(self, region_id=None):
+        """
+        Compute changes between consecutive snapshots: new orders, removed orders, and orders whose price or
+        volume changed.  The book is converted to columnar form once and all snapshot pairs of a region are
+        diffed in one vectorized pass.
+
+        :param region_id: optional set of region IDs to diff.  If None, then diff all regions.
+        :return: generator yielding a SnapshotDiff for each consecutive pair of snapshots, region by region.
+                 Orders in the diffs are ORDER_DTYPE arrays.
+        """
+        return self.to_columnar().diffs(region_id)
+
     @staticmethod
     def __read_index__(fobj, max_offset):
         """
         Read order book index file and return a map from type to offsets.
         :param fobj: file object to read from
         :param max_offset: max offset to report for last value
-        :return: map from type to array of offsets
-        """
-        result = {}
-        last_type = -1
-        for line in gzip.GzipFile(fileobj=fobj).readlines():
-            line = line.decode('utf-8')
-            fields = line.split(" ")
-            type_id = int((fields[0].split("_"))[1])
-            offset = int(fields[1])
-            result[type_id] = [offset, -1]
-            if last_type != -1:
-                result[last_type][1] = offset - 1
-            last_type = type_id
-            if last_type != -1:
-                result[last_type][1] = max_offset
-        return result
+        :return: BulkIndex mapping type to (start, end) offsets
+        """
+        return BulkIndex.parse(fobj, max_offset)
 
     @staticmethod
-    def __read_bulk_file__(target_date, types, regions, parent_dir=".", is_tree=True):
+    def __read_bulk_file__(target_date, types, regions, parent_dir=".", is_tree=True, columnar=False, workers=1,
+                           index_sidecar=False):
         """
         Extract the specified types and regions out of a bulk market history local file
         :param target_date: date to extract
@@ -277,8 +438,13 @@ class OrderBook:
         :param regions: array-like of regions to extract
         :param parent_dir: parent directory where local files are stored
         :param is_tree: if true, market history is organized as a tree
+        :param columnar: if true, return ColumnarOrderBook objects instead of OrderBook objects
+        :param workers: number of processes used to decompress and parse type blocks.  If greater than one,
+                        type blocks are parsed in a process pool and returned in the same order as a serial read.
+        :param index_sidecar: if true, keep a binary copy of the index next to the index file
         :return: array of extracted MarketHistory objects
         """
+        book_class = ColumnarOrderBook if columnar else OrderBook
         path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
         date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
         bulk_file = parent_dir + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5.bulk"
@@ -288,121 +454,264 @@ class OrderBook:
         results = []
         try:
             max_offset = os.stat(bulk_file).st_size
-            index_map = OrderBook.__read_index__(open(index_file, 'rb'), max_offset)
-            # If the number of requested types is above some threshold, then linearly scan
-            # the bulk file as this will be substantially more efficient in time.
-            if len(types) > 1500:
-                # Scan the entire file, skipping types we don't care about
-                sorted_map = []
-                scanned = 0
-                for x in index_map.keys():
-                    sorted_map.append(dict(type=x, start=index_map[x][0], end=index_map[x][1]))
-                sorted_map = sorted(sorted_map, key=lambda k: k['start'])
-                fd = open(bulk_file, 'rb')
-                for next_type in sorted_map:
-                    start = next_type['start']
-                    end = next_type['end']
-                    buff = fd.read(end - start + 1)
-                    scanned += 1
-                    if next_type['type'] not in types:
-                        continue
-                    ps = gzip.GzipFile(fileobj=io.BytesIO(buff))
-                    results.append(OrderBook(target_date, ps=ps, region_id=regions))
-                    ps.close()
-                    if scanned % 1000 == 0:
-                        print("+", end='')
-                    if len(results) == len(types):
-                        # All types loaded, short circuit
-                        break
-                fd.close()
+            if max_offset == 0:
+                return []
+            index_map = BulkIndex.load(index_file, max_offset, index_sidecar)
+            # If the number of requested types is above some threshold, then read types in file
+            # order as this will be substantially more efficient in time.
+            scan = len(types) > 1500
+            if scan:
+                type_set = set(types)
+                to_load = [x for x in index_map.keys() if x in type_set]
             else:
-                # Handle one type at a type
-                for next_type in types:
-                    if next_type not in index_map:
-                        continue
-                    start = index_map[next_type][0]
-                    end = index_map[next_type][1]
-                    fd = open(bulk_file, 'rb')
-                    fd.seek(start)
-                    buff = fd.read(end - start + 1)
-                    ps = gzip.GzipFile(fileobj=io.BytesIO(buff))
-                    results.append(OrderBook(target_date, ps=ps, region_id=regions))
-                    ps.close()
-                    fd.close()
+                to_load = [x for x in types if x in index_map]
+            # When only some regions are wanted, a region index (see index_regions) lets us skip the rest
+            region_index = RegionIndex.load(bulk_file) if regions is not None else None
+            region_slices = {} if region_index is None else {x: region_index.slices(x, regions) for x in to_load}
+            if workers > 1 and len(to_load) > 1:
+                # Fan type blocks out to a process pool.  Workers return parsed columns, which are much
+                # cheaper to send back than MarketOrder objects.  map preserves submission order.
+                ranges = [(bulk_file, index_map[x][0], index_map[x][1], regions, region_slices.get(x))
+                          for x in to_load]
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunk_size = max(1, len(ranges) // (workers * 4))
+                    for next_columns in executor.map(parse_bulk_range, *zip(*ranges), chunksize=chunk_size):
+                        results.append(OrderBook.__book_from_columns__(target_date, next_columns, columnar))
+                        if scan and len(results) % 1000 == 0:
+                            print("+", end='')
+                return results
+            # Map the bulk file once and hand slices of the mapping straight to decompression.
+            # Other processes reading the same day share the page cache.
+            with open(bulk_file, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for next_type in to_load:
+                        with view[index_map[next_type][0]:index_map[next_type][1] + 1] as block:
+                            if region_slices.get(next_type) is not None:
+                                next_columns = parse_region_slices(block, region_slices[next_type], regions)
+                                results.append(OrderBook.__book_from_columns__(target_date, next_columns, columnar))
+                            else:
+                                results.append(book_class.from_block(target_date, decompress_block(block),
+                                                                     region_id=regions))
+                        if scan and len(results) % 1000 == 0:
+                            print("+", end='')
+                finally:
+                    view.release()
         except OSError:
             return []
         return results
 
     @staticmethod
-    def __read_archive__(target_date, types, regions):
+    def __book_from_columns__(target_date, columns, columnar):
+        """
+        Wrap a parsed (type_id, region columns) tuple as a book.
+
+        :param target_date: datetime for day represented by the book
+        :param columns: tuple (type_id, map from region ID to SnapshotColumns)
+        :param columnar: if true, return a ColumnarOrderBook instead of an OrderBook
+        :return: new book
+        """
+        book = ColumnarOrderBook(target_date)
+        book.type_id, book.region = columns
+        return book if columnar else OrderBook.from_columnar(book)
+
+    @staticmethod
+    def __read_compiled_file__(target_date, types, regions, parent_dir=".", is_tree=True, columnar=False):
+        """
+        Extract the specified types and regions out of a compiled book store created by compile_day.
+
+        :param target_date: date to extract
+        :param types: array-like of types to extract
+        :param regions: array-like of regions to extract
+        :param parent_dir: parent directory where local files are stored
+        :param is_tree: if true, local storage is organized as a tree
+        :param columnar: if true, return ColumnarOrderBook objects instead of OrderBook objects
+        :return: array of extracted books, or None if there is no usable compiled store for this date
+        """
+        path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
+        date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
+        base_name = parent_dir + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5"
+        store_file = base_name + ".book"
+        bulk_file = base_name + ".bulk"
+        try:
+            # Ignore stores which are older than the bulk file they were compiled from
+            if os.path.exists(bulk_file) and os.stat(store_file).st_mtime < os.stat(bulk_file).st_mtime:
+                return None
+            store = BookStore(store_file)
+        except OSError:
+            return None
+        # Same ordering rules as __read_bulk_file__
+        if len(types) > 1500:
+            type_set = set(types)
+            to_load = [x for x in store.types if x in type_set]
+        else:
+            to_load = [x for x in types if x in store]
+        results = []
+        for next_type in to_load:
+            next_book = store.read(target_date, next_type, regions)
+            results.append(next_book if columnar else OrderBook.from_columnar(next_book))
+        return results
+
+    @staticmethod
+    def compile_day(date, local_storage, config=None):
+        """
+        Convert a local interval bulk file into a compiled book store (interval_YYYYMMDD_5.book) in the
+        same directory.  get_day will load books from the compiled store in preference to the bulk file,
+        which avoids decompressing and parsing on every load.  A region index (see index_regions) is written
+        for the bulk file at the same time.
+
+        :param date: date to convert
+        :param local_storage: parent directory for local storage containing order book data
+        :param config: optional config parameter with settings:
+          verbose - if True, show what we're doing when we do it
+          tree - if True, then local storage is organized as a date tree
+          index_sidecar - if True, keep a binary copy of the bulk index next to the index file
+        :return: number of types written to the compiled store
+        """
+        config = {} if config is None else config
+        verbose = config.get('verbose', False)
+        is_tree = config.get('tree', False)
+        path_string = "%04d/%02d/%02d" % (date.year, date.month, date.day)
+        date_string = "%04d%02d%02d" % (date.year, date.month, date.day)
+        base_name = local_storage + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5"
+        bulk_file = base_name + ".bulk"
+        index_file = base_name + ".index.gz"
+        if (not os.path.exists(bulk_file)) or (not os.path.exists(index_file)):
+            raise Exception("No bulk data found for date %s" % date)
+        max_offset = os.stat(bulk_file).st_size
+        index_map = BulkIndex.load(index_file, max_offset, config.get('index_sidecar', False))
+        ordered = index_map.keys()
+        blocks = []
+
+        def books(view):
+            for count, next_type in enumerate(ordered, 1):
+                with view[index_map[next_type][0]:index_map[next_type][1] + 1] as block:
+                    data = decompress_block(block)
+                blocks.append(block_region_offsets(data))
+                yield ColumnarOrderBook.from_block(date, data)
+                if verbose and count % 1000 == 0:
+                    print("+", end='')
+
+        if verbose:
+            print("compiling %s..." % bulk_file, end="")
+        with open(bulk_file, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as bulk_view:
+                written = BookStore.write(base_name + ".book", books(bulk_view))
+        RegionIndex.from_blocks(blocks).write(RegionIndex.path_for(bulk_file))
+        if verbose:
+            print("done")
+        return written
+
+    @staticmethod
+    def index_regions(date, local_storage, config=None):
         """
-        Read market history from archive.
+        Build a region index (interval_YYYYMMDD_5.regions.npy) for a local interval bulk file.  The region
+        index records where each region starts within each decompressed type block, which lets get_day
+        skip decompressing and parsing unwanted regions when the regions argument is not None.  The index is
+        built automatically by download_order_book_range and compile_day; run this for bulk files obtained
+        some other way.  Region indexes older than the bulk file are ignored.
+
+        :param date: date to index
+        :param local_storage: parent directory for local storage containing order book data
+        :param config: optional config parameter with settings:
+          verbose - if True, show what we're doing when we do it
+          tree - if True, then local storage is organized as a date tree
+        :return: the new RegionIndex
+        """
+        config = {} if config is None else config
+        verbose = config.get('verbose', False)
+        is_tree = config.get('tree', False)
+        path_string = "%04d/%02d/%02d" % (date.year, date.month, date.day)
+        date_string = "%04d%02d%02d" % (date.year, date.month, date.day)
+        base_name = local_storage + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5"
+        bulk_file = base_name + ".bulk"
+        index_file = base_name + ".index.gz"
+        if (not os.path.exists(bulk_file)) or (not os.path.exists(index_file)):
+            raise Exception("No bulk data found for date %s" % date)
+        index_map = BulkIndex.load(index_file, os.stat(bulk_file).st_size, config.get('index_sidecar', False))
+        if verbose:
+            print("indexing %s..." % bulk_file, end="")
+        with open(bulk_file, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                blocks = []
+                for next_type, (start, end) in index_map.items():
+                    with view[start:end + 1] as block:
+                        blocks.append(block_region_offsets(decompress_block(block)))
+                    if verbose and len(blocks) % 1000 == 0:
+                        print("+", end='')
+        result = RegionIndex.from_blocks(blocks)
+        result.write(RegionIndex.path_for(bulk_file))
+        if verbose:
+            print("done")
+        return result
+
+    @staticmethod
+    def __read_archive__(target_date, types, regions, columnar=False, archive_url=None, max_concurrency=1,
+                         cache=None):
+        """
+        Read order books from the online archive.  The type blocks for all requested types are fetched with
+        a few coalesced range requests over pooled connections (see ArchiveClient).  With max_concurrency
+        greater than one, requests are sent concurrently and blocks are decompressed in the fetching threads
+        while earlier blocks are parsed.
         :param target_date: target date to retrieve
         :param types: array-like of types to retrieve
         :param regions: array-like of regions to retrieve
-        :return: array of retrieved MarketHistory objects
+        :param columnar: if true, return ColumnarOrderBook objects instead of OrderBook objects
+        :param archive_url: base URL of the archive, or None for the default archive
+        :param max_concurrency: maximum number of concurrent requests
+        :param cache: optional ArchiveCache to read through
+        :return: array of retrieved OrderBook objects
         """
+        book_class = ColumnarOrderBook if columnar else OrderBook
+        client = ArchiveClient.get_client(archive_url)
         date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
         path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
-        bulk_file = "interval_" + date_string + "_5.bulk"
-        index_file = "interval_" + date_string + "_5.index.gz"
-        bulk_url = "https://storage.googleapis.com/evekit_md/" + path_string + "/" + bulk_file
-        index_url = "https://storage.googleapis.com/evekit_md/" + path_string + "/" + index_file
+        bulk_file = path_string + "/interval_" + date_string + "_5.bulk"
+        index_file = path_string + "/interval_" + date_string + "_5.index.gz"
         max_offset = -1
-        results = []
         try:
-            index_map = OrderBook.__read_index__(urllib.request.urlopen(index_url), max_offset)
-            for next_type in types:
-                if next_type not in index_map:
-                    continue
-                range_string = "bytes=" + str(index_map[next_type][0]) + "-"
-                if index_map[next_type][1] != -1:
-                    range_string += str(index_map[next_type][1])
-                request = urllib.request.Request(bulk_url, headers={"Range": range_string})
-                ps = gzip.GzipFile(fileobj=urllib.request.urlopen(request))
-                results.append(OrderBook(target_date, ps=ps, region_id=regions))
-                ps.close()
+            index_map = OrderBook.__read_index__(io.BytesIO(client.fetch(index_file, cache)), max_offset)
+            found = [x for x in dict.fromkeys(types) if x in index_map]
+            books = {}
+            for pos, block in client.iter_ranges(bulk_file, [index_map[x] for x in found],
+                                                 max_concurrency=max_concurrency, decode=gzip.decompress,
+                                                 cache=cache):
+                books[found[pos]] = book_class.from_block(target_date, block, region_id=regions)
         except urllib.error.HTTPError:
             return []
-        return results
+        return [books[x] for x in types if x in books]
 
     @staticmethod
-    def __read_service__(target_date, types, regions):
+    def __read_service__(target_date, types, regions, pool=None, service_url=None):
         """
         Read order books from Orbital Enterprises market data service.  A separate call is made
         for each type, region and snapshot.  This is very inefficient for large sets of types or regions.
-        Use carefully.  Also note that we arbitrarily select five minute snapshots for the given date
-        starting from midnight (instead of using the actual snapshots available in the data, which is
-        not known when using the market service).
+        Use carefully, preferably with a ServicePool which makes calls concurrently.  Also note that we
+        arbitrarily select five minute snapshots for the given date starting from midnight (instead of
+        using the actual snapshots available in the data, which is not known when using the market service).
 
         :param target_date: date for which order books will be retrieved
         :param types: array-like of types to retrieve
         :param regions: array-like of regions to retrieve
+        :param pool: ServicePool used to make calls, or None to make calls one at a time
+        :param service_url: URL of the market data service swagger spec, or None for the default service
         :return: array of OrderBook results
         """
         five_minute_delta = datetime.timedelta(minutes=5)
-        client = Client.MarketData.get()
+        client = Client.MarketData.get(service_url)
+        pool = ServicePool() if pool is None else pool
+        start_time = target_date.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=datetime.timezone.utc)
+        dates = [str(start_time + five_minute_delta * i) + " UTC" for i in range(288)]
         results = []
         for next_type in types:
             new_book = OrderBook(target_date)
             new_book.type_id = next_type
             new_book.region = {}
             for next_region in regions:
-                snapshots = []
-                current_time = target_date.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=datetime.timezone.utc)
-                for _ in range(288):
-                    try:
-                        result, response = client.MarketData.book(typeID=next_type, regionID=next_region,
-                                                                  date=str(current_time) + " UTC").result()
-                        if response.status_code == 200:
-                            snapshots.append(MarketSnapshot.__from_service__(result))
-                    except HTTPError:
-                        # ignore
-                        pass
-                    finally:
-                        current_time = current_time + five_minute_delta
-                # Create new OrderBook from list of snapshots
-                new_book.region[next_region] = snapshots
+                # Convert each (type, region) as soon as its calls complete so that raw responses are released
+                calls = [dict(typeID=next_type, regionID=next_region, date=x) for x in dates]
+                new_book.region[next_region] = [MarketSnapshot.__from_service__(x)
+                                                for x in pool.map(client.MarketData.book, calls) if x is not None]
             results.append(new_book)
         return results
 
@@ -417,41 +726,138 @@ class OrderBook:
         :param config: optional config parameter with settings:
           verbose - if True, show what we're doing when we do it
           skip_missing - if True, skip missing data, otherwise throw an exception
-          local_storage - if present, gives the parent directory for local storage containing market history
+          local_storage - if present, gives the parent directory for local storage containing market history.
+                          A compiled store created by compile_day is used in preference to the bulk file.
           tree - if True, then local storage is organized as a date tree
           use_online - if True, use either the online archive or market data service to fill missing dates.
+          archive_url - base URL of the online archive (default archive_client.ARCHIVE_URL)
+          archive_concurrency - number of concurrent requests to the online archive (default 1)
+          archive_cache - if present, directory of a disk cache for data downloaded from the online archive
+          archive_cache_size - maximum size in bytes of the archive cache (default ArchiveCache.default_size).
+                               Least recently used data is evicted first.
+          service_workers - number of concurrent calls to the market data service (default 1)
+          service_rate - if present, maximum number of market data service calls started per second
+          service_timeout - if present, timeout in seconds for each market data service call
+          service_pool - if present, a ServicePool to use for market data service calls instead of creating one
+                         from the settings above.  Use this to share a rate limit or collect call statistics.
+          service_url - URL of the market data service swagger spec (default is the Orbital Enterprises service)
+          columnar - if True, return ColumnarOrderBook objects instead of OrderBook objects
+          workers - number of processes used to parse local bulk files (default 1)
+          index_sidecar - if True, keep a binary copy of each local bulk index next to the index file
+          book_cache - if True, keep parsed books in the shared in-process BookCache and serve repeated requests
+                       from it, or a BookCache instance to use instead.  Books are cached separately for each
+                       source (local files by path and modification time, or the archive and service URLs).
+                       Books from the cache hold read-only arrays (OrderBook objects are created fresh on each
+                       call).
+          book_cache_size - maximum approximate size in bytes of the shared book cache (default
+                            BookCache.default_size).  Least recently used books are evicted first.
         :return: an array of order books for the given day for each of the specified types and regions.
         """
-        results = []
         config = {} if config is None else config
+        cache = BookCache.from_config(config)
+        if cache is not None:
+            return OrderBook.__get_day_cached__(cache, date, types, regions, config)
+        results = []
         local_storage_dir = config.get('local_storage', '')
         use_local = len(local_storage_dir) > 0 and os.path.exists(local_storage_dir)
         use_online = config.get('use_online', True)
         verbose = config.get('verbose', False)
         skip_missing = config.get('skip_missing', True)
+        columnar = config.get('columnar', False)
         # Try local storage first if present, then online sources if configured
         if use_local:
             if verbose:
                 print("checking local source...", end="")
             is_tree = config.get('tree', False)
-            values = OrderBook.__read_bulk_file__(date, types, regions, local_storage_dir, is_tree)
+            values = OrderBook.__read_compiled_file__(date, types, regions, local_storage_dir, is_tree, columnar)
+            if values is None:
+                values = OrderBook.__read_bulk_file__(date, types, regions, local_storage_dir, is_tree, columnar,
+                                                      config.get('workers', 1), config.get('index_sidecar', False))
             results.extend(values)
         # Try online if no local storage, or local storage doesn't have data
         if len(results) == 0 and use_online:
             if verbose:
                 print("checking online sources...", end="")
             # Try archive first
-            values = OrderBook.__read_archive__(date, types, regions)
+            values = OrderBook.__read_archive__(date, types, regions, columnar, config.get('archive_url', None),
+                                                config.get('archive_concurrency', 1), ArchiveCache.from_config(config))
             if len(values) == 0:
                 # Last chance, try the market service.  This will be very slow for large
                 # amounts of data.
-                values = OrderBook.__read_service__(date, types, regions)
+                values = OrderBook.__read_service__(date, types, regions, ServicePool.from_config(config),
+                                                    config.get('service_url', None))
+                if columnar:
+                    values = [x.to_columnar() for x in values]
             results.extend(values)
         # If still no data, then check whether we should complain
         if len(results) == 0 and not skip_missing:
             raise Exception("No data found for date %s" % date)
         return results
 
+    @staticmethod
+    def __get_day_cached__(cache, date, types, regions, config):
+        """
+        Implementation of get_day for a config with a book cache.  Types not in the cache are loaded
+        together in columnar form and added to the cache.
+
+        :param cache: BookCache to use
+        :param date: date to retrieve
+        :param types: array-like of types to retrieve
+        :param regions: array-like of regions to retrieve, or None for all regions
+        :param config: config as passed to get_day
+        :return: an array of order books in the order of types
+        """
+        source = OrderBook.__source_key__(date, config)
+        found = {}
+        missing = []
+        for next_type in dict.fromkeys(types):
+            region_map = cache.get(date, next_type, regions, source)
+            if region_map is None:
+                missing.append(next_type)
+            else:
+                found[next_type] = region_map
+        if len(missing) > 0:
+            load_config = dict(config, book_cache=None, columnar=True, skip_missing=True)
+            for next_book in OrderBook.get_day(date, missing, regions, load_config):
+                found[next_book.type_id] = cache.put(date, next_book.type_id, regions, next_book.region, source)
+        results = []
+        for next_type in types:
+            if next_type in found:
+                next_book = ColumnarOrderBook(date)
+                next_book.type_id = next_type
+                next_book.region = found[next_type]
+                results.append(next_book if config.get('columnar', False) else OrderBook.from_columnar(next_book))
+        if len(results) == 0 and not config.get('skip_missing', True):
+            raise Exception("No data found for date %s" % date)
+        return results
+
+    @staticmethod
+    def __source_key__(date, config):
+        """
+        Identify the data get_day reads for a date, so that cached books are not shared between sources or
+        reused after local files are replaced (e.g. by a new download or compile_day).
+
+        :param date: date to retrieve
+        :param config: config as passed to get_day
+        :return: hashable key for the source
+        """
+        local_storage_dir = config.get('local_storage', '')
+        if len(local_storage_dir) > 0 and os.path.exists(local_storage_dir):
+            is_tree = config.get('tree', False)
+            path_string = "%04d/%02d/%02d" % (date.year, date.month, date.day)
+            date_string = "%04d%02d%02d" % (date.year, date.month, date.day)
+            base_name = local_storage_dir + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5"
+            stamps = []
+            for next_file in (base_name + ".book", base_name + ".bulk"):
+                if os.path.exists(next_file):
+                    stat = os.stat(next_file)
+                    stamps.append((next_file, stat.st_mtime_ns, stat.st_size))
+            if len(stamps) > 0:
+                return 'local', os.path.abspath(local_storage_dir), is_tree, tuple(stamps)
+        if config.get('use_online', True):
+            return 'online', config.get('archive_url', None), config.get('service_url', None)
+        return None
+
     @staticmethod
     def get_data_frame(dates, types, regions, config=None):
         """
@@ -470,36 +876,363 @@ class OrderBook:
           local_storage - if present, gives the parent directory for local storage containing order book data
           tree - if True, then local storage is organized as a date tree
           use_online - if True, use either the online archive or market data service to fill missing dates.
+          archive_url - base URL of the online archive (default archive_client.ARCHIVE_URL)
+          archive_concurrency - number of concurrent requests to the online archive (default 1)
+          archive_cache - if present, directory of a disk cache for data downloaded from the online archive
+          archive_cache_size - maximum size in bytes of the archive cache (default ArchiveCache.default_size).
+                               Least recently used data is evicted first.
+          service_workers - number of concurrent calls to the market data service (default 1)
+          service_rate - if present, maximum number of market data service calls started per second
+          service_timeout - if present, timeout in seconds for each market data service call
+          service_pool - if present, a ServicePool to use for market data service calls instead of creating one
+                         from the settings above.  Use this to share a rate limit or collect call statistics.
+          service_url - URL of the market data service swagger spec (default is the Orbital Enterprises service)
           fill_gaps - if True, fill gaps of missing orders
-        :return: DataFrame containing the requested data indexed by book snapshot time.
+          columnar - if True, load books in columnar form instead of as MarketOrder objects.  This uses substantially
+                     less memory for large books.  The resulting DataFrame is the same either way.
+          workers - number of processes used to parse local bulk files (default 1)
+          index_sidecar - if True, keep a binary copy of each local bulk index next to the index file
+          book_cache - if True, or a BookCache, cache parsed books as described in get_day.  With
+                       max_inflight_days > 1 and a process day_pool, the shared cache (True) is not used, and a
+                       BookCache instance causes days to be loaded in a thread pool instead.
+          max_inflight_days - number of days to load concurrently (default 1).  Results are identical to loading
+                              days one at a time.
+          max_memory - if present, approximate bound in bytes on memory used by days being loaded concurrently.
+                       The first day is loaded on its own, then the size of the largest day loaded so far is used
+                       as the estimate for each day in flight.
+          day_pool - 'process' (default) or 'thread', the type of pool used to load days concurrently.  A thread
+                     pool is used if service_pool or a BookCache instance is given, as these can't be shared
+                     with other processes.
+        :return: DataFrame containing the requested data indexed by book snapshot time.  type_id, region_id and
+                 duration are int32 columns and order_range is categorical.
         """
         config = {} if config is None else config
         verbose = config.get('verbose', False)
         fill_gaps = config.get('fill_gaps', False)
         # Turn off verbose in called methods
         config['verbose'] = False
+        max_inflight_days = config.get('max_inflight_days', 1)
+        # Days loaded in parallel cross a process boundary, which is much cheaper for columnar books.
+        # The DataFrame is the same either way.
+        day_config = config if max_inflight_days <= 1 else dict(config, columnar=True)
         results = []
+        for next_date, books in load_days(dates, OrderBook.get_day, (types, regions, day_config), max_inflight_days,
+                                          config.get('max_memory', None), OrderBook.__books_nbytes__,
+                                          config.get('day_pool', 'process')):
+            if verbose:
+                print("Retrieving %s...done" % (str(next_date)))
+            results.extend(books)
+        return OrderBook.__books_data_frame__(results, fill_gaps)
+
+    @staticmethod
+    def __books_nbytes__(books):
+        """
+        Estimate the memory used by a list of books.
+
+        :param books: array-like of OrderBook or ColumnarOrderBook
+        :return: approximate size in bytes
+        """
+        total = 0
+        for next_book in books:
+            if isinstance(next_book, ColumnarOrderBook):
+                total += next_book.nbytes
+            else:
+                # MarketOrder objects are several times larger than their packed form
+                total += 8 * ORDER_DTYPE.itemsize * sum([len(x.bid) + len(x.ask) for snaps in next_book.region.values()
+                                                         for x in snaps])
+        return total
+
+    @staticmethod
+    def __books_data_frame__(books, fill_gaps=False):
+        """
+        Flatten order books into a DataFrame with one row per order per snapshot.  Each output column is
+        allocated once at its final size and filled book by book, so peak memory is close to the size of
+        the final frame.  OrderBook objects are converted to columns one book at a time.
+
+        :param books: array-like of OrderBook or ColumnarOrderBook
+        :param fill_gaps: if True, fill gaps of missing orders before flattening
+        :return: DataFrame containing all orders indexed by book snapshot time.  type_id, region_id and duration
+                 are int32, and order_range is categorical.
+        """
+        total = 0
+        for next_book in books:
+            if fill_gaps:
+                next_book.fill_gaps()
+            if isinstance(next_book, ColumnarOrderBook):
+                total += sum([len(x.orders) for x in next_book.region.values()])
+            else:
+                total += sum([len(x.bid) + len(x.ask) for snaps in next_book.region.values() for x in snaps])
+        if total == 0:
+            return DataFrame()
+        fields = ['order_id', 'buy', 'issued', 'price', 'volume_entered', 'min_volume', 'volume', 'order_range',
+                  'location_id', 'duration']
+        out = {x: np.empty(total, dtype=ORDER_DTYPE[x]) for x in fields}
+        dates = np.empty(total, dtype=np.int64)
+        type_ids = np.empty(total, dtype=np.int32)
+        region_ids = np.empty(total, dtype=np.int32)
+        pos = 0
+        for next_book in books:
+            region_columns = next_book.region if isinstance(next_book, ColumnarOrderBook) else \
+                next_book.to_columnar().region
+            for region_id in region_columns.keys():
+                columns = region_columns[region_id]
+                end = pos + len(columns.orders)
+                for x in fields:
+                    out[x][pos:end] = columns.orders[x]
+                dates[pos:end] = np.repeat(columns.snapshot_time, np.diff(columns.offsets))
+                type_ids[pos:end] = next_book.type_id
+                region_ids[pos:end] = region_id
+                pos = end
+        out['issued'] = pd.to_datetime(out['issued'], unit='ms', utc=True)
+        codes, order_range = np.unique(out['order_range'], return_inverse=True)
+        out['order_range'] = pd.Categorical.from_codes(order_range.astype(np.int8),
+                                                       categories=decode_order_ranges(codes))
+        del order_range
+        dates = pd.DatetimeIndex(pd.to_datetime(dates, unit='ms', utc=True))
+        out['date'] = dates
+        out['type_id'] = type_ids
+        out['region_id'] = region_ids
+        return DataFrame(out, index=dates, copy=False)
+
+    @staticmethod
+    def top_of_book(dates, types, regions, location=None, config=None):
+        """
+        Retrieve best bid and ask price and volume for each snapshot.  Books are loaded a few types at a time
+        in columnar form, reduced to the top of book, and discarded, so peak memory is bounded by the books of
+        one batch of types rather than a whole day.  This is practical for large type sets where
+        get_data_frame is not.
+
+        :param dates: array-like date range to retrieve.
+        :param types: array-like types to retrieve.
+        :param regions: array-like regions to retrieve.
+        :param location: optional location ID, or array-like of location IDs.  If present, only orders at
+                         these locations are considered.
+        :param config: optional config parameter with settings:
+          verbose - if True, show what we're doing as we do it
+          skip_missing - if True, skip dates for which data can not be found
+          local_storage - if present, gives the parent directory for local storage containing order book data
+          tree - if True, then local storage is organized as a date tree
+          use_online - if True, use either the online archive or market data service to fill missing dates.
+          archive_url - base URL of the online archive (default archive_client.ARCHIVE_URL)
+          archive_concurrency - number of concurrent requests to the online archive (default 1)
+          archive_cache - if present, directory of a disk cache for data downloaded from the online archive
+          archive_cache_size - maximum size in bytes of the archive cache (default ArchiveCache.default_size).
+                               Least recently used data is evicted first.
+          service_workers - number of concurrent calls to the market data service (default 1)
+          service_rate - if present, maximum number of market data service calls started per second
+          service_timeout - if present, timeout in seconds for each market data service call
+          service_pool - if present, a ServicePool to use for market data service calls instead of creating one
+                         from the settings above.  Use this to share a rate limit or collect call statistics.
+          service_url - URL of the market data service swagger spec (default is the Orbital Enterprises service)
+          fill_gaps - if True, fill gaps of missing orders before computing the top of book
+          workers - number of processes used to parse local bulk files (default 1)
+          book_cache - if True, or a BookCache, cache parsed books as described in get_day
+          top_of_book_types - number of types loaded at a time (default 100).  Smaller batches use less memory,
+                              larger batches make fewer, larger archive requests and keep more workers busy.
+        :return: DataFrame indexed by snapshot time with columns type_id, region_id, bid_price, bid_volume,
+                 ask_price, ask_volume and spread (ask_price - bid_price).  Prices are NaN and volumes 0 when
+                 a side is empty.
+        """
+        config = {} if config is None else config
+        verbose = config.get('verbose', False)
+        fill_gaps = config.get('fill_gaps', False)
+        # Missing data is checked for the whole day rather than for each batch of types
+        day_config = dict(config, verbose=False, columnar=True, skip_missing=True)
+        batch_types = max(1, config.get('top_of_book_types', 100))
+        types = list(types)
+        fields = ['bid_price', 'bid_volume', 'ask_price', 'ask_volume']
+        # Seed each column with an empty array of the right type so an empty result is still typed
+        parts = {'snapshot_time': [np.empty(0, dtype=np.int64)], 'type_id': [np.empty(0, dtype=np.int32)],
+                 'region_id': [np.empty(0, dtype=np.int32)], 'bid_price': [np.empty(0)],
+                 'bid_volume': [np.empty(0, dtype=np.int64)], 'ask_price': [np.empty(0)],
+                 'ask_volume': [np.empty(0, dtype=np.int64)]}
         for next_date in dates:
             if verbose:
                 print("Retrieving %s" % (str(next_date)), end="...")
-            results.extend(OrderBook.get_day(next_date, types, regions, config))
+            found = False
+            for first in range(0, len(types), batch_types):
+                for next_book in OrderBook.get_day(next_date, types[first:first + batch_types], regions, day_config):
+                    found = True
+                    if fill_gaps:
+                        next_book.fill_gaps()
+                    for region_id in next_book.region.keys():
+                        columns = next_book.region[region_id]
+                        top = top_of_book_columns(columns, location)
+                        for x in fields:
+                            parts[x].append(top[x])
+                        parts['snapshot_time'].append(columns.snapshot_time)
+                        parts['type_id'].append(np.full(len(columns), next_book.type_id, dtype=np.int32))
+                        parts['region_id'].append(np.full(len(columns), region_id, dtype=np.int32))
+            if not found and not config.get('skip_missing', True):
+                raise Exception("No data found for date %s" % next_date)
             if verbose:
                 print("done")
-        # Fix gaps if requested
-        if fill_gaps:
-            for ob in results:
-                ob.fill_gaps()
-        # Flatten order book snapshots into an array
-        order_list = []
-        for next_book in results:
-            type_id = next_book.type_id
-            for region_id in next_book.region.keys():
-                for next_snap in next_book.region[region_id]:
-                    snap_time = next_snap.snapshot_time
-                    for next_order in next_snap.bid + next_snap.ask:
-                        to_dict = next_order.__dict__
-                        to_dict['date'] = snap_time
-                        to_dict['type_id'] = type_id
-                        to_dict['region_id'] = region_id
-                        order_list.append(to_dict)
-        return DataFrame(order_list, [x['date'] for x in order_list])
+        data = {x: np.concatenate(parts[x]) for x in parts.keys()}
+        data['spread'] = data['ask_price'] - data['bid_price']
+        index = pd.DatetimeIndex(pd.to_datetime(data.pop('snapshot_time'), unit='ms', utc=True))
+        return DataFrame(data, columns=['type_id', 'region_id'] + fields + ['spread'], index=index)
+
+    @staticmethod
+    def __local_block_source__(target_date, parent_dir, is_tree, resources, index_sidecar=False):
+        """
+        Locate type blocks in a local bulk file for streaming.
+
+        :param target_date: date to locate
+        :param parent_dir: parent directory where local files are stored
+        :param is_tree: if true, local storage is organized as a tree
+        :param resources: ExitStack which closes the mapped bulk file once streaming is finished
+        :param index_sidecar: if true, keep a binary copy of the index next to the index file
+        :return: map from type ID to a function returning a tuple (read, size) for the compressed type block,
+                 where read(start, end) returns bytes [start, end) of the block, or None if no local data exists
+                 for the date
+        """
+        path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
+        date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
+        bulk_file = parent_dir + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5.bulk"
+        index_file = parent_dir + "/" + (path_string if is_tree else "") + "/interval_" + date_string + "_5.index.gz"
+        if (not os.path.exists(bulk_file)) or (not os.path.exists(index_file)):
+            return None
+        max_offset = os.stat(bulk_file).st_size
+        if max_offset == 0:
+            return None
+        index_map = BulkIndex.load(index_file, max_offset, index_sidecar)
+        # All streams share one mapping of the bulk file.  Reads return copies so that no views of the
+        # mapping are left open when it is closed.
+        with open(bulk_file, 'rb') as fd:
+            mm = resources.enter_context(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+
+        def block(start, end):
+            return (lambda x, y: mm[start + x:start + y]), min(end + 1, max_offset) - start
+        return {k: (lambda r=v: block(r[0], r[1])) for k, v in index_map.items()}
+
+    @staticmethod
+    def __archive_block_source__(target_date, archive_url=None):
+        """
+        Locate type blocks in the online archive for streaming.
+
+        :param target_date: date to locate
+        :param archive_url: base URL of the archive, or None for the default archive
+        :return: map from type ID to a function returning a tuple (read, size) for the compressed type block,
+                 where read(start, end) returns bytes [start, end) of the block, or None if the archive does not
+                 have the date
+        """
+        client = ArchiveClient.get_client(archive_url)
+        date_string = "%04d%02d%02d" % (target_date.year, target_date.month, target_date.day)
+        path_string = "%04d/%02d/%02d" % (target_date.year, target_date.month, target_date.day)
+        bulk_file = path_string + "/interval_" + date_string + "_5.bulk"
+        try:
+            index_map = OrderBook.__read_index__(
+                io.BytesIO(client.fetch(path_string + "/interval_" + date_string + "_5.index.gz")), -1)
+        except urllib.error.HTTPError:
+            return None
+
+        def block(start, end):
+            # One request per type block, which is held until all of its streams are finished
+            view = memoryview(client.fetch_range(bulk_file, start, end))
+            return (lambda x, y: view[x:y]), len(view)
+        return {k: (lambda r=v: block(r[0], r[1])) for k, v in index_map.items()}
+
+    @staticmethod
+    def __stream_day__(target_date, types, regions, config, resources):
+        """
+        Create one snapshot stream for each (type, region) pair on the given date.  Each type block is
+        read once and shared by the streams of its regions.
+
+        :param target_date: date to stream
+        :param types: array-like of types to stream
+        :param regions: array-like of regions to stream, or None for all regions
+        :param config: config as passed to iter_snapshots
+        :param resources: ExitStack which releases bulk data once the streams are finished
+        :return: list of generators yielding (type_id, region_id, SnapshotColumns) for one snapshot at a time
+        """
+        local_storage_dir = config.get('local_storage', '')
+        source = None
+        if len(local_storage_dir) > 0 and os.path.exists(local_storage_dir):
+            source = OrderBook.__local_block_source__(target_date, local_storage_dir, config.get('tree', False),
+                                                      resources, config.get('index_sidecar', False))
+        if source is None and config.get('use_online', True):
+            source = OrderBook.__archive_block_source__(target_date, config.get('archive_url', None))
+        streams = []
+        if source is None:
+            # No bulk data, so streaming is not possible.  Load the day and replay it.
+            for next_book in OrderBook.get_day(target_date, types, regions, dict(config, columnar=True)):
+                for region_id in next_book.region.keys():
+                    streams.append(OrderBook.__replay_columns__(next_book.type_id, region_id,
+                                                                next_book.region[region_id]))
+            return streams
+        for next_type in types:
+            if next_type not in source:
+                continue
+            read, size = source[next_type]()
+            for region_id, lines in split_block_regions(read, size, regions, OrderBook.__stream_chunk_size__):
+                streams.append(iter_block_snapshots(lines, [region_id]))
+        return streams
+
+    @staticmethod
+    def __replay_columns__(type_id, region_id, columns):
+        for i in range(len(columns)):
+            start = columns.offsets[i]
+            end = columns.offsets[i + 1]
+            yield type_id, region_id, SnapshotColumns.from_counts(columns.snapshot_time[i:i + 1],
+                                                                  columns.bid_count[i:i + 1],
+                                                                  [end - start - columns.bid_count[i]],
+                                                                  columns.orders[start:end])
+
+    @staticmethod
+    def iter_snapshots(dates, types, regions, config=None):
+        """
+        Iterate over order book snapshots in time order without materializing whole days.  Bulk data
+        is decompressed and parsed incrementally as snapshots are requested, so that only about one
+        snapshot per (type, region) pair is held in memory at a time.  Each type block is read once, and
+        decompressed about twice however many regions are streamed: once to locate the regions, and
+        once as snapshots are requested.  Blocks read from the online archive are held compressed in
+        memory until the day is finished.  If no bulk data is available for a date (e.g. only the market
+        data service can provide it), then the day is loaded with get_day and replayed.
+
+        :param dates: array-like date range to iterate over.
+        :param types: array-like types for which snapshots will be retrieved.
+        :param regions: array-like regions for which snapshots will be retrieved, or None for all regions.
+        :param config: optional config parameter with settings:
+          verbose - if True, show what we're doing as we do it
+          local_storage - if present, gives the parent directory for local storage containing order book data
+          tree - if True, then local storage is organized as a date tree
+          use_online - if True, use either the online archive or market data service to fill missing dates.
+          archive_url - base URL of the online archive (default archive_client.ARCHIVE_URL)
+          columnar - if True, yield ColumnarOrderBook objects instead of OrderBook objects
+          index_sidecar - if True, keep a binary copy of each local bulk index next to the index file
+        :return: generator yielding tuples (snapshot_time, books) where books is a map from type ID to an order
+                 book holding just the snapshot at snapshot_time for each region.
+        """
+        config = {} if config is None else config
+        verbose = config.get('verbose', False)
+        columnar = config.get('columnar', False)
+        for next_date in dates:
+            if verbose:
+                print("Streaming %s" % (str(next_date)))
+            with contextlib.ExitStack() as resources:
+                heads = []
+                for next_stream in OrderBook.__stream_day__(next_date, types, regions, dict(config, verbose=False),
+                                                            resources):
+                    head = next(next_stream, None)
+                    if head is not None:
+                        heads.append((head, next_stream))
+                while len(heads) > 0:
+                    raw_time = min([x[0][2].snapshot_time[0] for x in heads])
+                    books = {}
+                    next_heads = []
+                    for head, next_stream in heads:
+                        type_id, region_id, columns = head
+                        if columns.snapshot_time[0] != raw_time:
+                            next_heads.append((head, next_stream))
+                            continue
+                        if type_id not in books:
+                            books[type_id] = ColumnarOrderBook(next_date)
+                            books[type_id].type_id = type_id
+                        books[type_id].region[region_id] = columns
+                        head = next(next_stream, None)
+                        if head is not None:
+                            next_heads.append((head, next_stream))
+                    heads = next_heads
+                    if not columnar:
+                        books = {k: OrderBook.from_columnar(v) for k, v in books.items()}
+                    yield convert_raw_time(int(raw_time)), books
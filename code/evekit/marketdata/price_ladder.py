@@ -0,0 +1,133 @@
+# evekit.marketdata.PriceLadder module
+"""
+Per-side price ladder for an order book snapshot with cumulative volume and notional arrays, so that
+the cost of sweeping a given volume or the volume available up to a limit price can be found with a
+binary search instead of walking orders.
+"""
+import numpy as np
+
+
+class PriceLadder:
+    """
+    One side of an order book snapshot, ordered best price first.  Asks are ordered by ascending price
+    and bids by descending price.  Orders at the same price keep their book order.
+
+    Sweeps follow the same rules as walking the order list one order at a time: an order is used only
+    if the volume still to be filled is at least the order's min_volume.  When no order is skipped for
+    this reason, which is the usual case, lookups are O(log n).  Otherwise the walk resumes from the first
+    skipped order.
+    """
+    def __init__(self, price, volume, min_volume, buy):
+        """
+        Create a ladder from order arrays in any order.
+
+        :param price: array-like of order prices
+        :param volume: array-like of order volumes
+        :param min_volume: array-like of order minimum volumes
+        :param buy: True for the bid side, False for the ask side
+        """
+        price = np.asarray(price, dtype=np.float64)
+        self.buy = buy
+        order = np.argsort(-price if buy else price, kind='stable')
+        self.price = price[order]
+        self.volume = np.asarray(volume, dtype=np.int64)[order]
+        self.min_volume = np.asarray(min_volume, dtype=np.int64)[order]
+        self.cum_volume = np.cumsum(self.volume)
+        self.cum_notional = np.cumsum(self.price * self.volume)
+        self.__key__ = -self.price if buy else self.price
+        # Volume needed when reaching order i for the order to be used, and its running maximum.  A sweep of
+        # volume V skips no order before index i if V >= __reach__[i].
+        previous = self.cum_volume - self.volume
+        self.__reach__ = np.maximum.accumulate(previous + self.min_volume) if len(self.price) > 0 else previous
+        # Orders which can not be completely taken on their own.  Sweeping a full prefix skips nothing
+        # before the first such order.
+        blocked = np.flatnonzero(self.min_volume > self.volume)
+        self.__first_blocked__ = int(blocked[0]) if len(blocked) > 0 else len(self.price)
+
+    @staticmethod
+    def from_orders(orders, buy, location=None):
+        """
+        Create a ladder from an ORDER_DTYPE array.
+
+        :param orders: structured array of orders with dtype ORDER_DTYPE
+        :param buy: True to use the bids in orders, False to use the asks
+        :param location: optional location ID to restrict orders to
+        :return: new PriceLadder
+        """
+        keep = orders['buy'] == buy
+        if location is not None:
+            keep &= orders['location_id'] == location
+        selected = orders[keep]
+        return PriceLadder(selected['price'], selected['volume'], selected['min_volume'], buy)
+
+    def __len__(self):
+        return len(self.price)
+
+    @property
+    def total_volume(self):
+        return int(self.cum_volume[-1]) if len(self.cum_volume) > 0 else 0
+
+    def sweep_cost(self, volume):
+        """
+        Total price paid (asks) or received (bids) to fill the given volume, walking the ladder from the
+        best price.
+
+        :param volume: volume to fill
+        :return: total cost, or None if the ladder can not fill the volume
+        """
+        if volume <= 0:
+            return 0.0
+        last = int(np.searchsorted(self.cum_volume, volume, side='left'))
+        if last == len(self.price):
+            # Skipping orders can only reduce the volume available
+            return None
+        skipped = int(np.searchsorted(self.__reach__, volume, side='right'))
+        if skipped > last:
+            filled_before = self.cum_volume[last] - self.volume[last]
+            cost = self.cum_notional[last - 1] if last > 0 else 0.0
+            return float(cost + (volume - filled_before) * self.price[last])
+        # Some order is skipped because of min_volume, walk the rest of the ladder
+        remaining = volume - (self.cum_volume[skipped] - self.volume[skipped])
+        cost = float(self.cum_notional[skipped - 1]) if skipped > 0 else 0.0
+        for i in range(skipped, len(self.price)):
+            if remaining >= self.min_volume[i] and self.volume[i] > 0:
+                amount = min(remaining, self.volume[i])
+                cost += amount * self.price[i]
+                remaining -= amount
+            if remaining == 0:
+                return float(cost)
+        return None
+
+    def average_price(self, volume):
+        """
+        :param volume: volume to fill
+        :return: volume weighted price of a sweep of the given volume, or None if it can not be filled
+        """
+        cost = self.sweep_cost(volume)
+        return None if cost is None or volume <= 0 else cost / volume
+
+    def max_volume_at(self, limit_price):
+        """
+        Largest volume a single sweep can fill using only orders at or better than the limit price.
+
+        :param limit_price: worst acceptable price, i.e. the highest price for asks or the lowest for bids
+        :return: volume available
+        """
+        count = int(np.searchsorted(self.__key__, -limit_price if self.buy else limit_price, side='right'))
+        if count == 0:
+            return 0
+        if count <= self.__first_blocked__:
+            return int(self.cum_volume[count - 1])
+        # Some order can not be taken on its own, so decide from the worst price back whether each order
+        # can be used given the volume that follows it.
+        following = 0
+        for i in range(count - 1, -1, -1):
+            if following + self.volume[i] >= self.min_volume[i]:
+                following += self.volume[i]
+        return int(following)
+
+    def __str__(self):
+        return "PriceLadder[%s, levels=%d, volume=%d]" % ('bid' if self.buy else 'ask', len(self), self.total_volume)
+
+    def __repr__(self):
+        return str(self)
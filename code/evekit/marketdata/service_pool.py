@@ -0,0 +1,151 @@
+# evekit.marketdata.ServicePool module
+"""
+Concurrent calls to the market data service.  Calls are issued from a pool of worker threads, limited
+by a token bucket rate limiter, and timed so that per-call latency statistics can be reported.
+"""
+import time
+import threading
+import concurrent.futures
+import numpy as np
+from bravado.exception import HTTPError, BravadoTimeoutError, BravadoConnectionError
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.  Tokens are added at a fixed rate up to a maximum of burst tokens, and
+    each call to acquire takes one token, waiting for it if necessary.  Safe to share between threads.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens added per second
+        :param burst: maximum number of tokens which can accumulate
+        """
+        if rate <= 0:
+            raise Exception("Rate must be positive: %s" % rate)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.__tokens__ = self.burst
+        self.__last__ = time.monotonic()
+        self.__lock__ = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until it is available.  Waiting callers are served in arrival order.
+        """
+        with self.__lock__:
+            now = time.monotonic()
+            self.__tokens__ = min(self.burst, self.__tokens__ + (now - self.__last__) * self.rate)
+            self.__last__ = now
+            # Reserve a token even if it is not yet available, then wait for it outside the lock
+            self.__tokens__ -= 1
+            wait = -self.__tokens__ / self.rate if self.__tokens__ < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ServicePool:
+    """
+    Pool for calling market data service operations concurrently.  Each call waits for the rate limiter (if
+    any), is made with the configured timeout, and has its latency recorded.  Calls which fail with an HTTP
+    error, a timeout or a connection error are counted and return None, as do calls with a status other
+    than 200.  A pool may be shared by several readers so that they share the rate limit and statistics.
+    """
+    def __init__(self, max_workers=1, rate=None, burst=1, timeout=None):
+        """
+        :param max_workers: number of calls made at once.  If 1, calls are made in the calling thread.
+        :param rate: optional maximum number of calls started per second
+        :param burst: number of calls which may be started at once before the rate applies
+        :param timeout: optional timeout in seconds for each call
+        """
+        self.max_workers = max_workers
+        self.limiter = None if rate is None else TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.__lock__ = threading.Lock()
+        self.reset_stats()
+
+    @staticmethod
+    def from_config(config):
+        """
+        Get the pool to use for a reader config.
+
+        :param config: config with optional settings service_pool, service_workers, service_rate and
+                       service_timeout as described in OrderBook.get_day
+        :return: config['service_pool'] if present, otherwise a new ServicePool from the other settings
+        """
+        if config.get('service_pool', None) is not None:
+            return config['service_pool']
+        return ServicePool(config.get('service_workers', 1), config.get('service_rate', None),
+                           timeout=config.get('service_timeout', None))
+
+    def reset_stats(self):
+        """
+        Clear call statistics.
+        """
+        with self.__lock__:
+            self.__latency__ = []
+            self.__counts__ = {'ok': 0, 'missing': 0, 'errors': 0, 'timeouts': 0}
+
+    def stats(self):
+        """
+        :return: dict with the number of calls, counts of calls by outcome (ok, missing for status 404 or any
+                 other status besides 200, errors and timeouts), and latency mean, p50, p95, p99 and max in seconds
+        """
+        with self.__lock__:
+            latency = np.array(self.__latency__)
+            result = dict(self.__counts__, calls=len(latency))
+        for name, value in (('mean', None), ('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)):
+            if len(latency) == 0:
+                result[name] = np.nan
+            else:
+                result[name] = float(latency.mean() if value is None else np.percentile(latency, value))
+        return result
+
+    def call(self, operation, **kwargs):
+        """
+        Make one call.
+
+        :param operation: service operation, e.g. Client.MarketData.get().MarketData.book
+        :param kwargs: operation arguments
+        :return: result of the call, or None if the call failed or did not return status 200
+        """
+        if self.limiter is not None:
+            self.limiter.acquire()
+        outcome = 'ok'
+        result = None
+        start = time.monotonic()
+        try:
+            result, response = operation(**kwargs).result(timeout=self.timeout)
+            if response.status_code != 200:
+                outcome = 'missing'
+                result = None
+        except BravadoTimeoutError:
+            outcome = 'timeouts'
+        except HTTPError as e:
+            outcome = 'missing' if e.status_code == 404 else 'errors'
+        except BravadoConnectionError:
+            outcome = 'errors'
+        elapsed = time.monotonic() - start
+        with self.__lock__:
+            self.__latency__.append(elapsed)
+            self.__counts__[outcome] += 1
+        return result
+
+    def map(self, operation, calls):
+        """
+        Make many calls concurrently.
+
+        :param operation: service operation, e.g. Client.MarketData.get().MarketData.book
+        :param calls: array-like of dicts of operation arguments
+        :return: list of call results in the same order as calls, with None for failed calls
+        """
+        if self.max_workers <= 1 or len(calls) <= 1:
+            return [self.call(operation, **x) for x in calls]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda x: self.call(operation, **x), calls))
+
+    def __str__(self):
+        stats = self.stats()
+        return "ServicePool[workers=%d, calls=%d, p50=%.3fs]" % (self.max_workers, stats['calls'], stats['p50'])
+
+    def __repr__(self):
+        return str(self)
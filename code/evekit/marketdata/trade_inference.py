@@ -0,0 +1,101 @@
+# evekit.marketdata.TradeInference module
+"""
+Infer trades from changes between consecutive order book snapshots
+"""
+import numbers
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from .columnar_book import ColumnarOrderBook, ORDER_RANGE_STATION, match_snapshot_orders
+
+
+class TradeInference:
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def infer_trades(books, volume_threshold=None):
+        """
+        Infer trades from order books.  For each consecutive pair of snapshots in each region:
+
+        - an order present in both snapshots whose volume changed is an actual trade of the volume difference
+          at the price in the later snapshot.
+        - an order removed in the later snapshot is assumed to be a complete fill (actual is False) if its
+          volume does not exceed the volume threshold for its type, otherwise it is treated as a cancel.
+
+        The trade location is the order location, except for buy orders with a range other than 'station'
+        where the location is unknown (<NA>).  Trades are timestamped with the time of the later snapshot.
+        Orders are matched across all snapshots of a region at once (see match_snapshot_orders).
+
+        :param books: an OrderBook or ColumnarOrderBook, or array-like of either
+        :param volume_threshold: None to treat every removed order as a fill, a number to use as the threshold
+                                 for all types, or a map (e.g. dict or Series) from type ID to threshold.  Removed
+                                 orders for types missing from the map are treated as cancels.
+        :return: DataFrame of inferred trades indexed by timestamp, with columns timestamp, type_id, region_id,
+                 actual, buy, order_id, price, volume and location.  Trades are ordered by book, region and
+                 snapshot, with volume changes before removals within a snapshot pair.
+        """
+        if not isinstance(books, (list, tuple)):
+            books = [books]
+        parts = []
+        for next_book in books:
+            columnar = next_book if isinstance(next_book, ColumnarOrderBook) else next_book.to_columnar()
+            if volume_threshold is None or isinstance(volume_threshold, numbers.Number):
+                threshold = volume_threshold
+            else:
+                threshold = volume_threshold[columnar.type_id] if columnar.type_id in volume_threshold else np.nan
+            for region_id in columnar.region.keys():
+                part = TradeInference.__infer_region__(columnar.region[region_id], threshold)
+                if part is not None:
+                    part['type_id'] = np.full(len(part['order_id']), columnar.type_id, dtype=np.int32)
+                    part['region_id'] = np.full(len(part['order_id']), region_id, dtype=np.int32)
+                    parts.append(part)
+        columns = ['timestamp', 'type_id', 'region_id', 'actual', 'buy', 'order_id', 'price', 'volume', 'location']
+        if len(parts) == 0:
+            return DataFrame(columns=columns)
+        data = {x: np.concatenate([p[x] for p in parts]) for x in columns}
+        known = np.concatenate([p['known'] for p in parts])
+        timestamp = pd.DatetimeIndex(pd.to_datetime(data['timestamp'], unit='ms', utc=True))
+        data['timestamp'] = timestamp
+        data['location'] = pd.array(data['location'], dtype='Int64')
+        data['location'][~known] = pd.NA
+        return DataFrame(data, columns=columns, index=timestamp)
+
+    @staticmethod
+    def __infer_region__(columns, threshold):
+        """
+        Infer trades for all snapshot pairs of a single (type, region).
+
+        :param columns: SnapshotColumns to process
+        :param threshold: removed order volume threshold, or None to keep all removed orders
+        :return: map from column name to array, or None if there are fewer than two snapshots
+        """
+        if len(columns) < 2:
+            return None
+        orders = columns.orders
+        snap = columns.snapshot_index()
+        _, removed, before, after = match_snapshot_orders(columns)
+        changed = orders['volume'][before] != orders['volume'][after]
+        before = before[changed]
+        after = after[changed]
+        if threshold is not None:
+            removed = removed[orders['volume'][removed] <= threshold]
+        source = np.concatenate([before, removed])
+        # Order by snapshot pair, with volume changes before removals within a pair.  lexsort is stable so
+        # book order is kept within each group.
+        pair = snap[source]
+        kind = np.concatenate([np.zeros(len(before), dtype=np.int8), np.ones(len(removed), dtype=np.int8)])
+        order = np.lexsort((kind, pair))
+        source = source[order]
+        actual = (kind == 0)[order]
+        price = np.concatenate([orders['price'][after], orders['price'][removed]])[order]
+        volume = np.concatenate([orders['volume'][before] - orders['volume'][after], orders['volume'][removed]])[order]
+        selected = orders[source]
+        return {'timestamp': columns.snapshot_time[pair[order] + 1],
+                'actual': actual,
+                'buy': selected['buy'],
+                'order_id': selected['order_id'],
+                'price': price,
+                'volume': volume,
+                'location': selected['location_id'],
+                'known': ~selected['buy'] | (selected['order_range'] == ORDER_RANGE_STATION)}
@@ -4,6 +4,7 @@ import urllib.error
 import os
 import gzip
 import shutil
+from evekit.marketdata import OrderBook
 
 
 def __download_market_history__(target_date, parent_dir):
@@ -235,12 +236,15 @@ def download_order_book_range(date_range, parent_dir, types=None, regions=None,
         verbose - if True, display what we're doing
         tree - if True, store downloads in a tree of directories, e.g. parent_dir/YYYY/MM/DD/...
         skip_missing - if True, skip missing data.  Otherwise, throw an exception on missing data.
+        index_regions - if True (default), build a region index for each downloaded file (see
+                        OrderBook.index_regions) so that reads of selected regions skip the others
     :return: None
     """
     config = {} if config is None else config
     verbose = config.get('verbose', False)
     tree = config.get('tree', False)
     skip_missing = config.get('skip_missing', True)
+    index_regions = config.get('index_regions', True)
     for next_date in date_range:
         if verbose:
             print("Downloading " + str(next_date), end="...")
@@ -251,6 +255,8 @@ def download_order_book_range(date_range, parent_dir, types=None, regions=None,
                 target_dir = parent_dir + "/" + path_string
                 os.makedirs(target_dir, exist_ok=True)
             __download_order_book__(next_date, target_dir, types, regions)
+            if index_regions:
+                OrderBook.index_regions(next_date, parent_dir, {'tree': tree})
             if verbose:
                 print("done")
         except (urllib.error.HTTPError, OSError) as e:
@@ -24,7 +24,7 @@ class __ExternalClientMap:
     def get(self, client_type, key):
         if client_type not in self.client_map:
             return None
-        return self.client_map[client_type][key]
+        return self.client_map[client_type].get(key)
 
     def set(self, client_type, key, value):
         if client_type not in self.client_map:
@@ -83,20 +83,23 @@ class SDE:
 
 class MarketData:
     @staticmethod
-    def get():
+    def get(url=None):
         """
         Get a Swagger client for the Orbital Enterprises Market Data service
+        :param url: optional URL of the service swagger spec, e.g. for a local copy of the service
         :return: a SwaggerClient for the Market Data service
         """
         global __external_clients__
-        existing = __external_clients__.get('MarketData', True)
+        key = True if url is None else url
+        existing = __external_clients__.get('MarketData', key)
         if existing is None:
-            existing = SwaggerClient.from_url("https://evekit-market.orbital.enterprises//swagger",
+            url = "https://evekit-market.orbital.enterprises//swagger" if url is None else url
+            existing = SwaggerClient.from_url(url,
                                               config={'use_models': False,
                                                       'validate_responses': False,
                                                       'validate_requests': False,
                                                       'also_return_response': True})
-            __external_clients__.set('MarketData', True, existing)
+            __external_clients__.set('MarketData', key, existing)
         return existing
 
 